@@ -0,0 +1,138 @@
+"""
+Read replica routing for the web workers. settings.py installs ReplicaRouter
+and ReplicaPinningMiddleware when a replica is configured. Reads go to it and
+writes to default, except that reads stay on default:
+
+- for the rest of a request that is not a GET, HEAD or OPTIONS,
+- for replica_sticky_seconds after a client's write, so it reads what it wrote,
+- inside use_primary(),
+- while the replica is more than replica_max_lag seconds behind, or its lag
+  cannot be read.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from prometheus_client import Counter, Gauge
+
+REPLICA = 'replica'
+# set on responses to writes, reads stay on the primary while it lasts
+PIN_COOKIE = 'read_primary'
+
+replica_max_lag = float(os.environ.get("REPLICA_MAX_LAG", "5"))
+replica_lag_check_interval = float(os.environ.get("REPLICA_LAG_CHECK_INTERVAL", "5"))
+replica_sticky_seconds = int(os.environ.get("REPLICA_STICKY_SECONDS", "10"))
+
+replica_lag_seconds = Gauge('db_replica_lag_seconds', 'Replica lag at the last check, -1 when it could not be read')
+replica_fallbacks = Counter('db_replica_fallbacks_total', 'Reads sent to the primary instead of the replica', ['reason'])
+
+_use_primary = contextvars.ContextVar('use_primary', default=False)
+
+# 0 on a primary, and when a standby has replayed everything it received.
+# NULL when a standby's WAL receiver is not streaming: the LSNs stay equal
+# once it disconnects, however far the primary moves on. pg_stat_wal_receiver
+# hides the status from roles without pg_read_all_stats, e.g. pg_monitor, so
+# without it reads stay on the primary.
+POSTGRESQL_LAG = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+def measure_lag(connection):
+    """Seconds the replica is behind, or None when replication is broken."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(POSTGRESQL_LAG)
+            lag = cursor.fetchone()[0]
+        elif connection.vendor == 'mysql':
+            cursor.execute('SHOW REPLICA STATUS')
+            row = cursor.fetchone()
+            if row is None:
+                # not replicating, e.g. a second local database standing in for a replica
+                return 0.0
+            status = dict(zip([column[0] for column in cursor.description], row))
+            if status.get('Replica_IO_Running') != 'Yes':
+                # a replica that lost the source shows the lag of what it already received
+                return None
+            lag = status.get('Seconds_Behind_Source')
+        else:
+            return 0.0
+    return None if lag is None else float(lag)
+
+
+class ReplicaLag:
+    """A replica's lag, measured at most once per interval seconds in each process."""
+
+    def __init__(self, alias, interval):
+        self.alias = alias
+        self.interval = interval
+        self.lag = None
+        self._checked_at = None
+
+    def healthy(self, max_lag):
+        if self._checked_at is None or time.monotonic() - self._checked_at >= self.interval:
+            try:
+                self.lag = measure_lag(connections[self.alias])
+            except Exception as e:
+                print('Replica lag check failed:', e)
+                self.lag = None
+            self._checked_at = time.monotonic()
+            replica_lag_seconds.set(-1 if self.lag is None else self.lag)
+        return self.lag is not None and self.lag <= max_lag
+
+
+replica_lag = ReplicaLag(REPLICA, replica_lag_check_interval)
+
+
+@contextmanager
+def use_primary():
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_primary.get():
+            return DEFAULT_DB_ALIAS
+        if not replica_lag.healthy(replica_max_lag):
+            replica_fallbacks.labels('lag').inc()
+            return DEFAULT_DB_ALIAS
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinningMiddleware:
+    """Keeps a request's reads on the primary when it writes, or when its client wrote recently."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        writes = request.method not in ('GET', 'HEAD', 'OPTIONS')
+        if not (writes or PIN_COOKIE in request.COOKIES):
+            return self.get_response(request)
+
+        if not writes:
+            replica_fallbacks.labels('sticky').inc()
+        with use_primary():
+            response = self.get_response(request)
+        if writes and response.status_code < 400:
+            response.set_cookie(PIN_COOKIE, '1', max_age=replica_sticky_seconds, httponly=True, samesite='Lax')
+        return response
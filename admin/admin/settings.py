@@ -9,60 +9,34 @@ https://docs.djangoproject.com/en/3.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
-import boto3
-import json
-from botocore.exceptions import ClientError
+import time
+startup_started = time.perf_counter()
+
 import os
 import json
 from pathlib import Path
 import requests
 
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME
-from opentelemetry.sdk.trace.export import SimpleSpanProcessor, BatchSpanProcessor
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-from opentelemetry.instrumentation.django import DjangoInstrumentor
-from opentelemetry.instrumentation.pika import PikaInstrumentor
+from . import secret_store
+from .telemetry import setup_tracing
 
 # OpenTelemetry configuration
-# Set service name
-
-jeager_url = os.environ.get("JAEGAR_URL")
-jeager_port = os.environ.get("JAEGAR_PORT")
-resource = Resource(attributes={
-    SERVICE_NAME: "django-service"
-})
-
-# Jaeger exporter configuration
-jaeger_exporter = JaegerExporter(
-    agent_host_name=jeager_url,  
-    agent_port=6831,
-)
-
-# Setup the tracer provider and add the Jaeger exporter
-trace.set_tracer_provider(TracerProvider(resource=resource))
-trace.get_tracer_provider().add_span_processor(BatchSpanProcessor(jaeger_exporter))
+if setup_tracing("django-service") is not None:
+    from opentelemetry.instrumentation.django import DjangoInstrumentor
+    from opentelemetry.instrumentation.pika import PikaInstrumentor
 
-# Instrument Django and RabbitMQ (Pika)
-DjangoInstrumentor().instrument()
-PikaInstrumentor().instrument()
+    # Instrument Django and RabbitMQ (Pika)
+    DjangoInstrumentor().instrument()
+    PikaInstrumentor().instrument()
 
 current_region = os.environ.get("AWS_REGION")
 secret_name = os.environ.get("SECRET_NAME")
 
-if not current_region or not secret_name:
+if not secret_store.secrets_file and (not current_region or not secret_name):
     raise RuntimeError("Missing required environment variables: AWS_REGION or DB_SECRET_NAME")
 
 def get_database_secrets():
-    try:
-        print(f"Fetching secret: {secret_name}")
-        client = boto3.client("secretsmanager", region_name=current_region)
-        response = client.get_secret_value(SecretId=secret_name)
-        return json.loads(response["SecretString"])
-    except ClientError as e:
-        print(f"Failed to fetch secret: {e}")
-        raise RuntimeError("Could not retrieve DB credentials")
+    return secret_store.get_secret(secret_name, current_region)
 secrets = get_database_secrets()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -129,9 +103,27 @@ WSGI_APPLICATION = 'admin.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
+# web for the HTTP workers, consumer for consumer.py and relay.py, which set it before django.setup()
+db_pool_profile = os.environ.get("DB_POOL_PROFILE", "web")
+DB_POOL_PROFILES = {
+    # keep a connection across requests, checked before reuse after a request
+    "web": {"CONN_MAX_AGE": 60, "CONN_HEALTH_CHECKS": True},
+    # hold it for the life of the process, close_old_connections() runs per batch
+    "consumer": {"CONN_MAX_AGE": None, "CONN_HEALTH_CHECKS": True},
+}
+db_pool = DB_POOL_PROFILES[db_pool_profile]
+if os.environ.get("DB_CONN_MAX_AGE"):
+    db_pool = {**db_pool, "CONN_MAX_AGE": int(os.environ["DB_CONN_MAX_AGE"])}
+
+# django_prometheus' wrappers count new connections, errors and query time
+sql_engine = os.environ.get("SQL_ENGINE", "django.db.backends.postgresql")
+if sql_engine in ("django.db.backends.postgresql", "django.db.backends.mysql", "django.db.backends.sqlite3"):
+    sql_engine = sql_engine.replace("django.db.backends.", "django_prometheus.db.backends.")
+
 DATABASES = {
     "default": {
-        "ENGINE": os.environ.get("SQL_ENGINE", "django.db.backends.postgresql"),
+        **db_pool,
+        "ENGINE": sql_engine,
         "NAME": secrets.get("dbname", os.environ.get("SQL_DATABASE", BASE_DIR / "db.sqlite3")),
         "USER": secrets.get("username", os.environ.get("SQL_USER", "user")),
         "PASSWORD": secrets.get("password", os.environ.get("SQL_PASSWORD", "password")),
@@ -139,6 +131,46 @@ DATABASES = {
         "PORT": secrets.get("port", os.environ.get("SQL_PORT", "5432")),
     }
 }
+
+# A read replica, SQL_REPLICA_HOST or a second local database in SQL_REPLICA_DATABASE,
+# takes the web workers' reads, see admin/replica.py. consumer.py and relay.py
+# read what they are about to write, so they always use the primary.
+replica_host = os.environ.get("SQL_REPLICA_HOST")
+replica_database = os.environ.get("SQL_REPLICA_DATABASE")
+if (replica_host or replica_database) and db_pool_profile == "web":
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "HOST": replica_host or DATABASES["default"]["HOST"],
+        "PORT": os.environ.get("SQL_REPLICA_PORT", DATABASES["default"]["PORT"]),
+        "NAME": replica_database or DATABASES["default"]["NAME"],
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_ROUTERS = ["admin.replica.ReplicaRouter"]
+    MIDDLEWARE.insert(1, "admin.replica.ReplicaPinningMiddleware")
+
+# Serialized product payloads, see products/cache.py. locmem is per process,
+# redis shares one cache between workers (PRODUCTS_CACHE_LOCATION=redis://...)
+PRODUCTS_CACHE_BACKENDS = {
+    "locmem": "products.cache.LocMemCache",
+    "redis": "django_prometheus.cache.backends.redis.NativeRedisCache",
+    "none": "django.core.cache.backends.dummy.DummyCache",
+}
+products_cache_backend = os.environ.get("PRODUCTS_CACHE_BACKEND", "locmem")
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "products": {
+        "BACKEND": PRODUCTS_CACHE_BACKENDS[products_cache_backend],
+        "LOCATION": os.environ.get("PRODUCTS_CACHE_LOCATION", "products"),
+        "TIMEOUT": int(os.environ.get("PRODUCTS_CACHE_TTL", "300")),
+    },
+}
+if products_cache_backend == "locmem":
+    # least recently used entries are culled past this size
+    CACHES["products"]["OPTIONS"] = {
+        "MAX_ENTRIES": int(os.environ.get("PRODUCTS_CACHE_MAX_ENTRIES", "10000")),
+    }
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -179,4 +211,7 @@ STATICFILES_DIRS = [
 
 STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
-CORS_ORIGIN_ALLOW_ALL = True
\ No newline at end of file
+CORS_ORIGIN_ALLOW_ALL = True
+
+print(f'Settings loaded in {time.perf_counter() - startup_started:.3f}s '
+      f'({secret_store.fetch_seconds:.3f}s fetching secrets)')
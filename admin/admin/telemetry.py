@@ -0,0 +1,47 @@
+import os
+
+from opentelemetry import trace
+
+tracing_enabled = os.environ.get("TRACING_ENABLED", "true").lower() not in ("0", "false", "no")
+# share of new traces that are recorded, child spans follow their parent's decision
+tracing_sample_ratio = float(os.environ.get("TRACING_SAMPLE_RATIO", "0.1"))
+jeager_url = os.environ.get("JAEGAR_URL")
+
+_provider = None
+
+
+def setup_tracing(service_name):
+    """
+    Installs the tracer provider once per process and returns it, or None
+    when tracing is disabled. The SDK and the Jaeger exporter are only
+    imported when tracing is on; otherwise the API stays on its no-op
+    tracers and spans cost next to nothing.
+    """
+    global _provider
+    if _provider is not None or not tracing_enabled:
+        return _provider
+
+    from opentelemetry.exporter.jaeger.thrift import JaegerExporter
+    from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    _provider = TracerProvider(
+        resource=Resource(attributes={SERVICE_NAME: service_name}),
+        sampler=ParentBased(TraceIdRatioBased(tracing_sample_ratio)),
+    )
+    jaeger_exporter = JaegerExporter(
+        agent_host_name=jeager_url,
+        agent_port=6831,
+        # the agent takes UDP packets of at most 65000 bytes
+        udp_split_oversized_batches=True,
+    )
+    _provider.add_span_processor(BatchSpanProcessor(
+        jaeger_exporter,
+        max_queue_size=int(os.environ.get("OTEL_BSP_MAX_QUEUE_SIZE", "8192")),
+        max_export_batch_size=int(os.environ.get("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256")),
+        schedule_delay_millis=int(os.environ.get("OTEL_BSP_SCHEDULE_DELAY", "2000")),
+    ))
+    trace.set_tracer_provider(_provider)
+    return _provider
@@ -1,62 +1,181 @@
-import pika, json, os, django
+import pika, os, django, time
+from collections import Counter
 
 from opentelemetry import trace
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
-from opentelemetry.context import attach, detach
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import SimpleSpanProcessor, BatchSpanProcessor
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "admin.settings")
+os.environ.setdefault("DB_POOL_PROFILE", "consumer")
 django.setup()
 
-from products.models import Product
+from django.db import close_old_connections, transaction
+
+from admin.telemetry import setup_tracing
+from products.likes import HotProducts, compact_likes, increment_likes, like_compact_interval, like_shards
+from products.events import PUBLISHED_AT, decode
+from products.topology import (dead_letter_queue, declare_topology, event_stream, retry_delays, retry_queue,
+                               shard_queue, stream_priority)
+from runner import (Lane, WorkerStats, consume_lanes, consumer_shards, record_batch, serve_metrics,
+                    stage_seconds, supervise, worker_shards)
 rabbit_mq_url = os.environ.get("RABBIT_MQ_URL")
-jeager_url = os.environ.get("JAEGAR_URL")
-jeager_port = os.environ.get("JAEGAR_PORT")
-
-# Configure Tracer Provider
-trace.set_tracer_provider(
-    TracerProvider(
-        resource=Resource({SERVICE_NAME: "django-service"})
-    )
-)
-jaeger_exporter = JaegerExporter(
-    agent_host_name=jeager_url,
-    agent_port=6831,
-)
-trace.get_tracer_provider().add_span_processor(BatchSpanProcessor(jaeger_exporter))
+
+# How many unacked messages the broker may push to us, and how we drain them
+prefetch_count = int(os.environ.get("RABBIT_MQ_PREFETCH", "500"))
+batch_size = int(os.environ.get("CONSUMER_BATCH_SIZE", str(prefetch_count)))
+batch_timeout = float(os.environ.get("CONSUMER_BATCH_TIMEOUT", "0.2"))
+
+# Reuses the provider installed by admin.settings
+setup_tracing("django-service")
 
 # Get the tracer
 tracer = trace.get_tracer(__name__)
 
-params = pika.URLParameters(rabbit_mq_url)
+# Products liked fast enough that their likes go to this worker's LikeShard rows
+hot_products = HotProducts()
+like_shard = 0
+
+
+def apply_likes(likes):
+    """
+    Applies a {product_id: count} batch as one UPDATE ... SET likes = likes + n
+    per product, all inside a single transaction. Hot products are counted
+    on this worker's shard row instead, see products/likes.py. Cached
+    payloads pick up the new counts within PRODUCTS_LIKES_MAX_AGE, see
+    products/cache.py.
+    """
+    hot_products.record(likes)
+    with transaction.atomic():
+        increment_likes(likes, like_shard, hot_products)
+
+
+def add_like(likes, data):
+    likes[int(data['id'])] += 1
+
+
+def add_likes(likes, data):
+    likes.update({int(product_id): count for product_id, count in data.items()})
+
+
+handlers = {
+    'product_liked': add_like,
+    'product_likes': add_likes,
+}
+
+# the streams this service consumes, one queue each per worker
+streams = sorted({event_stream(event_type) for event_type in handlers})
+
 
-connection = pika.BlockingConnection(params)
+def count_likes(events):
+    """
+    Folds (event_type, data) events into {product_id: count}: single likes
+    and the {product_id: count} deltas the products service flushes as
+    product_likes.
+    """
+    likes = Counter()
+    for event_type, data in events:
+        handler = handlers.get(event_type)
+        if handler is None:
+            print('Ignoring unknown event:', event_type)
+            continue
+        handler(likes, data)
+    return likes
 
-channel = connection.channel()
 
-channel.queue_declare(queue='admin')
+def flush(channel, batch, queue, lag=0):
+    """
+    Applies the buffered likes and acks every message up to the last delivery
+    tag in one multi-ack, only once the transaction has committed. lag is
+    the longest a message in the batch waited on the queue.
+    """
+    if not batch:
+        return
 
+    # replaces a connection the database dropped while the consumer sat idle
+    close_old_connections()
 
-def callback(ch, method, properties, body):
+    last_tag = batch[-1][0]
+    events = [event for _, _, message_events in batch for event in message_events]
+    likes = count_likes(events)
+    links = [
+        trace.Link(trace.get_current_span(context).get_span_context())
+        for _, context, _ in batch
+    ]
+
+    with tracer.start_as_current_span("process_likes_batch", links=links) as span:
+        span.set_attribute("batch.messages", len(batch))
+        span.set_attribute("batch.products", len(likes))
+        span.set_attribute("batch.likes", sum(likes.values()))
+        # on failure runner.flush_lane retries the messages one by one
+        with stage_seconds.labels(queue, 'apply').time():
+            apply_likes(likes)
+        with stage_seconds.labels(queue, 'ack').time():
+            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        record_batch(queue, len(batch), Counter(event_type for event_type, _ in events), lag)
+        print(f'Applied {sum(likes.values())} likes from {len(batch)} messages to {len(likes)} products')
+
+    batch.clear()
+
+
+def read(properties, body):
+    # decode() raises ValueError for a message it cannot read, which the runner dead letters
+    headers = properties.headers or {}
+    events = decode(properties.content_type, body)
     # Extract trace context from message headers
-    context = TraceContextTextMapPropagator().extract(properties.headers or {})
+    return TraceContextTextMapPropagator().extract(headers), events, headers.get(PUBLISHED_AT)
+
+
+def consume(connection, lanes, stopping=None, stats=None):
+    compacted = time.monotonic()
+
+    def flush_and_compact(channel, batch, queue, lag=0):
+        nonlocal compacted
+        flush(channel, batch, queue, lag)
+        if time.monotonic() - compacted < like_compact_interval:
+            return
+        compacted = time.monotonic()
+        # the batch is acked by now, a failure here must not send it to be retried
+        try:
+            with stage_seconds.labels(queue, 'compact').time():
+                moved = compact_likes(like_shard)
+            if moved:
+                print(f'Compacted {moved} sharded likes')
+        except Exception as e:
+            print('Failed to compact sharded likes:', e)
+
+    consume_lanes(connection, lanes, read, flush_and_compact, batch_size, batch_timeout, stopping, stats)
+
+
+def work(index, stopping):
+    """One runner worker: its own connection, and a channel and prefetch per shard queue it consumes."""
+    global like_shard
+    # each worker owns one LikeShard row per hot product, so workers never wait on each other's rows
+    like_shard = index % like_shards
+
+    connection = pika.BlockingConnection(pika.URLParameters(rabbit_mq_url))
+    declare_topology(connection.channel(), 'admin', streams, consumer_shards)
+
+    lanes = []
+    for stream in streams:
+        for shard in worker_shards(index):
+            channel = connection.channel()
+            channel.basic_qos(prefetch_count=prefetch_count)
+            # a failed message is only acked once the broker has its retry or dead letter copy
+            channel.confirm_delivery()
+            queue = shard_queue('admin', stream, shard)
+            lanes.append(Lane(
+                stream, queue, channel, stream_priority(stream),
+                retry_queues=[retry_queue(queue, delay) for delay in retry_delays],
+                dead_letter_queue=dead_letter_queue('admin', stream)
+            ))
 
-    with tracer.start_as_current_span("process_message", context=context):
-        print('Received in admin')
-        id = json.loads(body)
-        print(id)
-        product = Product.objects.get(id=id)
-        product.likes = product.likes + 1
-        product.save()
-        print('Product likes increased!')
-   
-channel.basic_consume(queue='admin', on_message_callback=callback, auto_ack=True)
+    serve_metrics(index)
+    print(f"Worker {index} consuming {', '.join(lane.queue for lane in lanes)}")
 
-print('Started Consuming')
+    try:
+        consume(connection, lanes, stopping, WorkerStats(index, lanes))
+    finally:
+        connection.close()
 
-channel.start_consuming()
 
-channel.close()
+if __name__ == '__main__':
+    supervise(work)
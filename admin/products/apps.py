@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ProductsConfig(AppConfig):
     name = 'products'
+
+    def ready(self):
+        # registers the signal handlers that keep the user id bounds fresh
+        from . import users  # noqa: F401
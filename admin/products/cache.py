@@ -0,0 +1,101 @@
+import os
+import time
+
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+from django.db.models import F
+from django_prometheus.cache.backends import locmem
+from prometheus_client import Counter
+
+from admin.replica import use_primary
+from .models import CatalogueVersion
+
+PRODUCTS_CACHE = 'products'
+products_version_ttl = float(os.environ.get("PRODUCTS_CACHE_VERSION_TTL", "1"))
+# like counts in cached payloads are at most this old
+products_likes_max_age = float(os.environ.get("PRODUCTS_LIKES_MAX_AGE", "10"))
+
+cache_evictions = Counter(
+    'django_cache_evictions_total',
+    'Entries culled from a full cache to make room for new ones',
+    ['backend']
+)
+
+
+class LocMemCache(locmem.LocMemCache):
+    """
+    django_prometheus' LocMemCache, which counts hits and misses, plus a
+    count of evictions. Django culls the least recently used entries.
+    """
+
+    def _cull(self):
+        size = len(self._cache)
+        super()._cull()
+        cache_evictions.labels(backend='locmem').inc(size - len(self._cache))
+
+
+class ProductCache:
+    """
+    Serialized product payloads, read through from the database. Keys carry
+    the catalogue version, so bumping it invalidates the entries of every
+    process, including web workers with a local memory cache. Each process
+    re-reads the version from the primary at most once per ttl seconds, and
+    payloads are only loaded from a read replica that has caught up to it.
+    Likes leave the version alone, so entries also expire with each
+    likes_max_age window of the wall clock, which every process shares.
+    """
+
+    def __init__(self, alias, ttl, likes_max_age):
+        self.alias = alias
+        self.ttl = ttl
+        self.likes_max_age = likes_max_age
+        self._version = None
+        self._checked_at = 0.0
+
+    def version(self):
+        if self._version is None or time.monotonic() - self._checked_at >= self.ttl:
+            self._version = self._read_version(DEFAULT_DB_ALIAS)
+            self._checked_at = time.monotonic()
+        return self._version
+
+    def likes_window(self):
+        return int(time.time() // self.likes_max_age)
+
+    @staticmethod
+    def _read_version(using):
+        return CatalogueVersion.objects.using(using).filter(id=1).values_list('version', flat=True).first() or 0
+
+    def get_or_load(self, key, load):
+        """Returns (payload, hit), calling load() and caching its result on a miss."""
+        cache = caches[self.alias]
+        version = self.version()
+        key = f'products:{version}.{self.likes_window()}:{key}'
+        payload = cache.get(key)
+        if payload is not None:
+            return payload, True
+
+        # a replica that is behind would cache old rows under the new version
+        using = router.db_for_read(CatalogueVersion)
+        if using != DEFAULT_DB_ALIAS and self._read_version(using) < version:
+            with use_primary():
+                payload = load()
+        else:
+            payload = load()
+        # entries of past windows are never read again, let them go rather than crowd out the rest
+        cache.set(key, payload, self.likes_max_age)
+        return payload, False
+
+    def invalidate(self):
+        """
+        Bumps the catalogue version once the current transaction commits.
+        For product creates, updates and deletes only: every writer takes the
+        same row, so per-like bumps would serialize the like consumers on it.
+        """
+        transaction.on_commit(self._bump)
+
+    def _bump(self):
+        CatalogueVersion.objects.filter(id=1).update(version=F('version') + 1)
+        self._version = None
+
+
+product_cache = ProductCache(PRODUCTS_CACHE, products_version_ttl, products_likes_max_age)
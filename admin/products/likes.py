@@ -0,0 +1,78 @@
+import os
+import time
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import LikeShard, Product
+
+# likes per second, over hot_product_window, above which a product counts as hot; 0 turns sharding off
+hot_product_threshold = float(os.environ.get("HOT_PRODUCT_LIKES_PER_SECOND", "50"))
+hot_product_window = float(os.environ.get("HOT_PRODUCT_WINDOW", "10"))
+like_shards = int(os.environ.get("LIKE_SHARDS", "8"))
+like_compact_interval = float(os.environ.get("LIKE_COMPACT_INTERVAL", "30"))
+
+
+class HotProducts:
+    """
+    Like rates seen by one consumer worker. Products that went over the
+    threshold during the last full window are hot until the next one ends.
+    """
+
+    def __init__(self, threshold=hot_product_threshold, window=hot_product_window):
+        self.threshold = threshold
+        self.window = window
+        self.hot = set()
+        self._counts = Counter()
+        self._started = time.monotonic()
+
+    def record(self, likes):
+        if not self.threshold:
+            return
+        self._counts.update(likes)
+        elapsed = time.monotonic() - self._started
+        if elapsed >= self.window:
+            self.hot = {product_id for product_id, count in self._counts.items() if count / elapsed >= self.threshold}
+            self._counts, self._started = Counter(), time.monotonic()
+
+    def __contains__(self, product_id):
+        return product_id in self.hot
+
+
+def increment_likes(likes, shard, hot=()):
+    """
+    Adds a {product_id: count} batch in one transaction. Rows are updated in
+    product id order so concurrent batches cannot deadlock, and hot products
+    get their count on the LikeShard row for shard instead of on the Product
+    row every worker is waiting for.
+    """
+    with transaction.atomic():
+        for product_id in sorted(likes):
+            count = likes[product_id]
+            if product_id not in hot:
+                Product.objects.filter(id=product_id).update(likes=F('likes') + count)
+                continue
+
+            shard_row = LikeShard.objects.filter(product_id=product_id, shard=shard)
+            if shard_row.update(likes=F('likes') + count) or not Product.objects.filter(id=product_id).exists():
+                continue
+            try:
+                with transaction.atomic():
+                    LikeShard.objects.create(product_id=product_id, shard=shard, likes=count)
+            except IntegrityError:
+                # a restarted worker with the same shard created it first
+                shard_row.update(likes=F('likes') + count)
+
+
+def compact_likes(shard):
+    """Folds the likes on shard's LikeShard rows back into Product.likes. Returns how many moved."""
+    with transaction.atomic():
+        rows = list(
+            LikeShard.objects.select_for_update().filter(shard=shard, likes__gt=0)
+            .order_by('product_id').values_list('id', 'product_id', 'likes')
+        )
+        for _, product_id, count in rows:
+            Product.objects.filter(id=product_id).update(likes=F('likes') + count)
+        LikeShard.objects.filter(id__in=[id for id, _, _ in rows]).update(likes=0)
+    return sum(count for _, _, count in rows)
@@ -0,0 +1,262 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from rest_framework.test import APIClient, APIRequestFactory
+
+from admin.replica import use_primary
+from products.likes import compact_likes, increment_likes
+from products.models import OutboxEvent, Product
+from products.topology import product_key
+from products.views import UserAPIView
+
+
+def measure(func, iterations):
+    """Calls func iterations times and summarises the latencies in milliseconds."""
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'p50_ms': round(statistics.median(latencies), 3),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'throughput_per_s': round(iterations / elapsed, 1),
+    }
+
+
+def grow_users(count, chunk=10000):
+    existing = User.objects.count()
+    for start in range(existing, count, chunk):
+        User.objects.bulk_create(
+            [User(username=f'bench{i}') for i in range(start, min(start + chunk, count))],
+            batch_size=chunk
+        )
+
+
+def bench_users(options):
+    """GET /api/user latency as the user table grows."""
+    view = UserAPIView.as_view()
+    factory = APIRequestFactory()
+    results = {}
+
+    for count in sorted(int(c) for c in options['user_counts'].split(',')):
+        grow_users(count)
+        cache.clear()
+        results[count] = measure(lambda: view(factory.get('/api/user')), options['iterations'])
+    return results
+
+
+def bench_crud(options):
+    """ProductViewSet create/list/retrieve/update/destroy through the full middleware stack."""
+    client = APIClient()
+    iterations = options['iterations']
+    ids = []
+
+    def create():
+        response = client.post('/api/products', {'title': 'product', 'image': 'product.png'}, format='json')
+        ids.append(response.data['id'])
+
+    results = {'create': measure(create, iterations)}
+    results['list'] = measure(lambda: client.get('/api/products'), iterations)
+    results['list_stream'] = measure(
+        lambda: b''.join(client.get('/api/products?stream=1').streaming_content), iterations
+    )
+
+    pending = iter(ids)
+    results['retrieve'] = measure(lambda: client.get(f'/api/products/{next(pending)}'), iterations)
+    pending = iter(ids)
+    results['update'] = measure(
+        lambda: client.put(f'/api/products/{next(pending)}', {'title': 'renamed', 'image': 'product.png'}, format='json'),
+        iterations
+    )
+    pending = iter(ids)
+    results['destroy'] = measure(lambda: client.delete(f'/api/products/{next(pending)}'), iterations)
+    return results
+
+
+def relay_messages():
+    """Messages relay.py would send for the current outbox, grouping each batch by partition."""
+    from relay import batch_size
+
+    keys = [product_key(payload) for payload in OutboxEvent.objects.order_by('id').values_list('payload', flat=True)]
+    return sum(len(set(keys[start:start + batch_size])) for start in range(0, len(keys), batch_size))
+
+
+def bench_bulk(options):
+    """A catalogue import created, updated and deleted one request per product and through the bulk endpoints."""
+    client = APIClient()
+    count = options['bulk_items']
+    items = [{'title': f'product {n}', 'image': f'{n}.png'} for n in range(count)]
+
+    def timed(func):
+        OutboxEvent.objects.all().delete()
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        return {
+            'seconds': round(elapsed, 3),
+            'items_per_s': round(count / elapsed, 1),
+            'outbox_events': OutboxEvent.objects.count(),
+            'relay_messages': relay_messages(),
+        }
+
+    ids = []
+    per_item = {
+        'create': timed(lambda: ids.extend(
+            client.post('/api/products', item, format='json').data['id'] for item in items
+        )),
+        'update': timed(lambda: [
+            client.put(f'/api/products/{id}', {'title': 'renamed', 'image': 'renamed.png'}, format='json')
+            for id in ids
+        ]),
+        'delete': timed(lambda: [client.delete(f'/api/products/{id}') for id in ids]),
+    }
+
+    ids = []
+    bulk = {
+        'create': timed(lambda: ids.extend(
+            product['id'] for product in client.post('/api/products/bulk', items, format='json').data
+        )),
+        'update': timed(lambda: client.put(
+            '/api/products/bulk', [{'id': id, 'title': 'renamed', 'image': 'renamed.png'} for id in ids], format='json'
+        )),
+        'delete': timed(lambda: client.delete('/api/products/bulk', {'ids': ids}, format='json')),
+    }
+    return {'items': count, 'per_item': per_item, 'bulk': bulk}
+
+
+def bench_likes(options):
+    """
+    Consumer workers applying like batches to one hot product at the same
+    time, with every batch on the Product row and with one LikeShard row per
+    worker. SQLite locks the whole database for every write, so run this
+    against the production engine (SQL_ENGINE and friends) to see row lock
+    contention.
+    """
+    workers, batches = options['like_workers'], options['iterations']
+    product = Product.objects.create(title='hot', image='hot.png')
+    others = [Product.objects.create(title=f'product {n}', image=f'{n}.png').id for n in range(workers)]
+
+    def run(shard, hot):
+        # every batch also likes a product only this worker touches, like a real batch would
+        latencies, errors = [], 0
+        try:
+            # threads do not inherit handle()'s use_primary()
+            with use_primary():
+                for _ in range(batches):
+                    start = time.perf_counter()
+                    try:
+                        increment_likes({product.id: 10, others[shard]: 1}, shard, hot)
+                    except OperationalError:
+                        errors += 1
+                    latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            connection.close()
+        return latencies, errors
+
+    results = {'workers': workers, 'batches_per_worker': batches}
+    for mode, hot in (('row', ()), ('sharded', {product.id})):
+        Product.objects.filter(id=product.id).update(likes=0)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(workers) as pool:
+            runs = list(pool.map(run, range(workers), [hot] * workers))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for run_latencies, _ in runs for latency in run_latencies)
+        compact_started = time.perf_counter()
+        for shard in range(workers):
+            compact_likes(shard)
+        results[mode] = {
+            'batches_per_s': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(statistics.median(latencies), 3),
+            'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3),
+            'errors': sum(errors for _, errors in runs),
+            'compact_ms': round((time.perf_counter() - compact_started) * 1000, 3),
+            'likes': Product.objects.get(id=product.id).likes,
+        }
+    return results
+
+
+TRACING_MODES = {
+    'disabled': {'TRACING_ENABLED': 'false'},
+    'ratio_0': {'TRACING_ENABLED': 'true', 'TRACING_SAMPLE_RATIO': '0'},
+    'ratio_0.1': {'TRACING_ENABLED': 'true', 'TRACING_SAMPLE_RATIO': '0.1'},
+    'ratio_1': {'TRACING_ENABLED': 'true', 'TRACING_SAMPLE_RATIO': '1'},
+}
+
+
+def bench_tracing(options):
+    """The crud scenario under each tracing mode, one process per mode."""
+    results = {}
+    for mode, env in TRACING_MODES.items():
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            subprocess.run(
+                [sys.executable, sys.argv[0], 'benchmark', 'crud',
+                 '--iterations', str(options['iterations']), '--output', output.name],
+                env={**os.environ, **env}, check=True, stdout=subprocess.DEVNULL
+            )
+            results[mode] = json.load(open(output.name))['results']['crud']
+    return results
+
+
+SCENARIOS = {
+    'users': bench_users,
+    'crud': bench_crud,
+    'bulk': bench_bulk,
+    'likes': bench_likes,
+    'tracing': bench_tracing,
+}
+
+
+class Command(BaseCommand):
+    help = 'Runs benchmarks against a throwaway test database and prints the results as JSON.'
+    # the main service has the matching scenarios for its endpoints and the queue path (main/benchmark.py)
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help=f"Any of {', '.join(SCENARIOS)}, all by default")
+        parser.add_argument('--iterations', type=int, default=1000)
+        parser.add_argument('--output', help='Also write the JSON results to this file')
+        parser.add_argument('--bulk-items', type=int, default=10000, help='Products imported by the bulk scenario')
+        parser.add_argument('--like-workers', type=int, default=8, help='Concurrent workers in the likes scenario')
+        parser.add_argument('--user-counts', default='1000,100000,1000000,10000000',
+                            help='Comma separated user table sizes for the users scenario')
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'] or list(SCENARIOS)
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # only the primary gets a test database, keep a configured replica out of it
+            with use_primary():
+                results = {name: SCENARIOS[name](options) for name in scenarios}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = {
+            'scenarios': scenarios,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results,
+        }
+        self.stdout.write(json.dumps(results, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,47 @@
+import json
+import os
+
+import pika
+from django.core.management.base import BaseCommand
+
+from products.events import decode
+from products.topology import dead_letter_queue, events_exchange
+from runner import dead_letters, describe_dead_letter, replay_dead_letters
+
+rabbit_mq_url = os.environ.get("RABBIT_MQ_URL")
+
+
+class Command(BaseCommand):
+    help = ('Inspects, replays or purges the dead letter queue of one of the streams consumer.py reads. '
+            'replay publishes the messages back with their original routing key and a fresh set of retries.')
+    # the main service has the same tool for its queues (main/deadletters.py)
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['list', 'replay', 'purge'])
+        parser.add_argument('stream', help='Stream whose dead letters to act on, e.g. product_likes')
+        parser.add_argument('--limit', type=int, default=None, help='At most this many messages, 20 for list')
+        parser.add_argument('--events', action='store_true', help='Also decode and print the events of listed messages')
+
+    def handle(self, *args, **options):
+        queue = dead_letter_queue('admin', options['stream'])
+        connection = pika.BlockingConnection(pika.URLParameters(rabbit_mq_url))
+        channel = connection.channel()
+        try:
+            if options['action'] == 'list':
+                for properties, body in dead_letters(channel, queue, options['limit'] or 20):
+                    message = describe_dead_letter(properties, body)
+                    if options['events']:
+                        try:
+                            message['events'] = decode(properties.content_type, body)
+                        except ValueError as e:
+                            message['events'] = f'unreadable: {e}'
+                    self.stdout.write(json.dumps(message, default=str))
+            elif options['action'] == 'replay':
+                channel.confirm_delivery()
+                replayed, skipped = replay_dead_letters(channel, queue, events_exchange('admin'), options['limit'])
+                self.stdout.write(f'Replayed {replayed} messages from {queue}, skipped {skipped} without a routing key')
+            else:
+                purged = channel.queue_purge(queue=queue).method.message_count
+                self.stdout.write(f'Purged {purged} messages from {queue}')
+        finally:
+            connection.close()
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+def create_version(apps, schema_editor):
+    apps.get_model('products', 'CatalogueVersion').objects.create(id=1, version=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogueVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
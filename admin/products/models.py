@@ -1,7 +1,42 @@
 from django.db import models
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+class ProductQuerySet(models.QuerySet):
+    def with_likes(self):
+        """Annotates total_likes: likes plus the likes on LikeShard rows not compacted yet."""
+        shard_likes = LikeShard.objects.filter(product=OuterRef('pk')).values('product') \
+            .annotate(total=Sum('likes')).values('total')
+        return self.annotate(total_likes=F('likes') + Coalesce(Subquery(shard_likes), 0))
 
 
 class Product(models.Model):
     title = models.CharField(max_length=200)
     image = models.CharField(max_length=200)
     likes = models.PositiveIntegerField(default=0)
+
+    objects = ProductQuerySet.as_manager()
+
+
+class OutboxEvent(models.Model):
+    # written in the same transaction as the product change, relayed by relay.py
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    headers = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class CatalogueVersion(models.Model):
+    # single row bumped on every product write, products.cache keys include it
+    version = models.BigIntegerField(default=0)
+
+
+class LikeShard(models.Model):
+    # likes for a hot product are spread over one row per consumer shard, see products/likes.py
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='like_shards')
+    shard = models.PositiveSmallIntegerField()
+    likes = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('product', 'shard')]
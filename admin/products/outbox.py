@@ -0,0 +1,24 @@
+from opentelemetry.context import get_current
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+
+from .models import OutboxEvent
+
+
+def publish_event(event_type, payload):
+    """
+    Records an event for relay.py to deliver to RabbitMQ. Call it inside the
+    transaction that changes the product so both commit or neither does.
+    """
+    headers = {}
+    # keep the request's trace context so the relay can continue it
+    TraceContextTextMapPropagator().inject(carrier=headers, context=get_current())
+    return OutboxEvent.objects.create(event_type=event_type, payload=payload, headers=headers)
+
+
+def publish_events(event_type, payloads):
+    """publish_event() for many payloads of one type, written with a single INSERT."""
+    headers = {}
+    TraceContextTextMapPropagator().inject(carrier=headers, context=get_current())
+    return OutboxEvent.objects.bulk_create(
+        [OutboxEvent(event_type=event_type, payload=payload, headers=headers) for payload in payloads]
+    )
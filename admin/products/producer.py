@@ -1,39 +1,140 @@
 import pika, json
+import threading
+import time
 from opentelemetry import trace
 from opentelemetry.context import get_current
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+from prometheus_client import Counter, Histogram
+from .events import PUBLISHED_AT, encode, publish_time
+from .topology import declare_exchange, events_exchange, product_key, routing_key
 import os
 # Get the tracer
 tracer = trace.get_tracer(__name__)
 rabbit_mq_url = os.environ.get("RABBIT_MQ_URL")
+rabbit_mq_heartbeat = int(os.environ.get("RABBIT_MQ_HEARTBEAT", "60"))
 
-def publish(method, body):
-    params = pika.URLParameters(rabbit_mq_url)
+publish_latency = Histogram(
+    'rabbitmq_publish_latency_seconds',
+    'Time spent publishing a message to RabbitMQ',
+    ['exchange']
+)
+publish_errors = Counter(
+    'rabbitmq_publish_errors_total',
+    'Messages that could not be published to RabbitMQ',
+    ['exchange']
+)
+publisher_reconnects = Counter(
+    'rabbitmq_publisher_reconnects_total',
+    'Publisher connections re-opened after the previous one was lost',
+    ['exchange']
+)
 
-    try:
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
 
+class Publisher:
+    """
+    Keeps one BlockingConnection and channel per thread for the whole life of
+    the process instead of doing a TCP + AMQP handshake on every publish.
+    pika connections are not thread safe, so gunicorn threads never share one.
+    """
+
+    def __init__(self, url, exchange, confirm=False):
+        self.url = url
+        self.exchange = exchange
+        # with publisher confirms basic_publish blocks until the broker has the message
+        self.confirm = confirm
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _parameters(self):
+        params = pika.URLParameters(self.url)
+        params.heartbeat = rabbit_mq_heartbeat
+        params.blocked_connection_timeout = rabbit_mq_heartbeat
+        return params
+
+    def _channel(self):
+        # gunicorn forks workers after the app is imported, never reuse the parent's socket
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+        channel = getattr(self._local, 'channel', None)
+        if channel is not None and channel.is_open:
+            # answer any heartbeats that arrived while the connection sat idle
+            channel.connection.process_data_events(time_limit=0)
+            return channel
+
+        if getattr(self._local, 'connection', None) is not None:
+            publisher_reconnects.labels(self.exchange).inc()
+            self.close()
+
+        self._local.connection = pika.BlockingConnection(self._parameters())
+        self._local.channel = self._local.connection.channel()
+        declare_exchange(self._local.channel, self.exchange)
+        if self.confirm:
+            self._local.channel.confirm_delivery()
+        return self._local.channel
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        self._local.channel = None
+        try:
+            if connection is not None and connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+
+    def publish(self, properties, body, routing_key):
+        start = time.perf_counter()
+        try:
+            # one retry on a fresh connection if the cached one went stale
+            for attempt in range(2):
+                try:
+                    self._channel().basic_publish(
+                        exchange=self.exchange,
+                        routing_key=routing_key,
+                        body=body,
+                        properties=properties
+                    )
+                    return
+                except pika.exceptions.AMQPError:
+                    self._local.channel = None
+                    if attempt:
+                        raise
+        except Exception:
+            publish_errors.labels(self.exchange).inc()
+            raise
+        finally:
+            publish_latency.labels(self.exchange).observe(time.perf_counter() - start)
+
+
+publisher = Publisher(rabbit_mq_url, exchange=events_exchange('main'))
+
+
+def publish(event_type, data, partition=None):
+    publish_events([(event_type, data)], partition or product_key(data))
+
+
+def publish_events(events, partition):
+    """
+    Sends (event_type, data) pairs in one message, see events.py. They must
+    all belong to the same stream, see topology.py.
+    """
+    try:
         with tracer.start_as_current_span("publish_message") as span:
+            span.set_attribute("message.events", len(events))
             headers = {}
             # Inject trace context into headers
             TraceContextTextMapPropagator().inject(carrier=headers, context=get_current())
 
+            headers[PUBLISHED_AT] = publish_time()
+            content_type, event_type, body = encode(events)
             properties = pika.BasicProperties(
-                content_type=method,
+                content_type=content_type,
+                type=event_type,
                 headers=headers  # Propagate trace context here
             )
 
-            channel.basic_publish(
-                exchange='',
-                routing_key='main',
-                body=json.dumps(body),
-                properties=properties
-            )
+            publisher.publish(properties, body, routing_key(events[0][0], partition))
     except Exception as e:
         print('RabbitMQ publish error:', e)
-    finally:
-        try:
-            connection.close()
-        except:
-            pass
@@ -1,3 +1,771 @@
-from django.test import TestCase
+import json
+from collections import defaultdict, deque
+from threading import Event
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+import pika
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+import runner
+from admin import replica
+from runner import (ATTEMPTS, ERROR, FAILED_AT, ROUTING_KEY, Lane, consume_lanes, flush_lane,
+                    replay_dead_letters)
+from .cache import product_cache
+from .checksums import checksum_buckets
+from .events import JSON, MSGPACK, PUBLISHED_AT, UnsupportedEvent, decode, encode, publish_time
+from .likes import HotProducts, compact_likes, increment_likes
+from .models import CatalogueVersion, LikeShard, OutboxEvent, Product
+from .outbox import publish_event
+from .topology import declare_topology, event_partitions, product_key, routing_key
+from .users import user_id_bounds
+from .views import stream_products
+
+
+class FakeChannel:
+    """
+    Queues in memory, with a message's properties encoded and decoded on the
+    way through like pika does, so headers AMQP cannot carry raise here too.
+    Publishes to an exchange land on the queue in routes, or are dropped.
+    """
+
+    def __init__(self, routes=None):
+        self.queues = defaultdict(deque)
+        self.routes = routes or {}
+        self.acked = []
+        self._consumers = {}
+        self._next_tag = 1
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        properties = properties or pika.BasicProperties()
+        copy = pika.BasicProperties()
+        copy.decode(b''.join(properties.encode()))
+        queue = routing_key if exchange == '' else self.routes.get(exchange)
+        if queue is not None:
+            self.queues[queue].append((routing_key, copy, body))
+
+    def basic_get(self, queue):
+        if not self.queues[queue]:
+            return None, None, None
+        routing_key, properties, body = self.queues[queue].popleft()
+        return self._method(routing_key), properties, body
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append(delivery_tag)
+
+    def queue_declare(self, queue, **kwargs):
+        return SimpleNamespace(method=SimpleNamespace(message_count=len(self.queues[queue])))
+
+    def basic_consume(self, queue, on_message_callback, **kwargs):
+        self._consumers[queue] = on_message_callback
+        return queue
+
+    def basic_cancel(self, consumer_tag):
+        self._consumers.pop(consumer_tag, None)
+
+    def process_data_events(self, time_limit=0):
+        for queue, on_message in list(self._consumers.items()):
+            while self.queues[queue]:
+                routing_key, properties, body = self.queues[queue].popleft()
+                on_message(self, self._method(routing_key), properties, body)
+
+    def _method(self, routing_key):
+        tag, self._next_tag = self._next_tag, self._next_tag + 1
+        return SimpleNamespace(delivery_tag=tag, routing_key=routing_key)
+
+
+def message(product_id, headers=None):
+    content_type, event_type, body = encode([('product_liked', {'id': product_id})])
+    return pika.BasicProperties(content_type=content_type, type=event_type, headers=headers), body
+
+
+def make_lane(channel, retries=2):
+    return Lane('product_liked', 'admin.product_liked.0', channel,
+                retry_queues=[f'admin.product_liked.0.retry.{n}' for n in range(retries)],
+                dead_letter_queue='admin.product_liked.dead')
+
+
+def add_to_batch(lane, tag, product_id):
+    properties, body = message(product_id)
+    lane.messages[tag] = ('product_liked.1', properties, body)
+    lane.batch.append((tag, None, [('product_liked', {'id': product_id})]))
+
+
+class DecodeTests(SimpleTestCase):
+    def test_round_trips_json_and_msgpack(self):
+        events = [('product_created', {'id': 1, 'title': 'a'}), ('product_deleted', {'id': 2})]
+        for encoding, expected in (('json', JSON), ('msgpack', MSGPACK)):
+            content_type, event_type, body = encode(events, encoding)
+            self.assertEqual(content_type, expected)
+            self.assertEqual(event_type, 'batch')
+            self.assertEqual(decode(content_type, body), events)
+
+    def test_upgrades_messages_from_before_the_envelope(self):
+        self.assertEqual(decode('product_deleted', json.dumps(7)), [('product_deleted', {'id': 7})])
+
+    def test_rejects_bodies_that_are_not_envelopes(self):
+        for body in ('[1,2]', '5', '"v"', '{"v":1}', '{"v":1,"events":[1]}', '{"v":1,"events":[["a"]]}'):
+            with self.subTest(body=body), self.assertRaises(UnsupportedEvent):
+                decode(JSON, body)
+        with self.assertRaises(UnsupportedEvent):
+            decode(MSGPACK, msgpack.packb([1, 2]))
+
+    def test_rejects_other_versions(self):
+        with self.assertRaises(UnsupportedEvent):
+            decode(JSON, '{"v":2,"events":[]}')
+
+    def test_rejects_bodies_that_do_not_parse(self):
+        with self.assertRaises(ValueError):
+            decode(JSON, '{')
+
+
+class DeliveryTimingTests(SimpleTestCase):
+    def test_stamps_messages_in_integer_milliseconds(self):
+        with mock.patch('products.events.time.time', return_value=1700000000.1234):
+            published_at = publish_time()
+        self.assertEqual(published_at, 1700000000123)
+        pika.BasicProperties(headers={PUBLISHED_AT: published_at}).encode()
+
+    def test_measures_queue_dwell_from_the_header(self):
+        with mock.patch('runner.time.time', return_value=1700000002.5):
+            self.assertAlmostEqual(runner.observe_delivery('admin.product_liked.0', 1700000000000), 2.5)
+            self.assertAlmostEqual(runner.observe_delivery('admin.product_liked.0', b'1700000001000'), 1.5)
+            # a publisher clock ahead of ours is no wait at all
+            self.assertEqual(runner.observe_delivery('admin.product_liked.0', 1700000009000), 0)
+            for published_at in (None, 'soon', [1]):
+                self.assertEqual(runner.observe_delivery('admin.product_liked.0', published_at), 0)
+
+
+class RejectTests(SimpleTestCase):
+    def setUp(self):
+        self.channel = FakeChannel()
+        self.lane = make_lane(self.channel)
+
+    def reject(self, tag, routing_key='product_liked.1', headers=None, retry=True):
+        properties, body = message(1, headers)
+        self.lane.messages[tag] = (routing_key, properties, body)
+        self.lane.reject(tag, RuntimeError('boom'), retry)
+
+    def test_moves_to_the_next_retry_queue_with_encodable_headers(self):
+        self.reject(1)
+        (routing_key, properties, _), = self.channel.queues['admin.product_liked.0.retry.0']
+        self.assertEqual(properties.headers[ATTEMPTS], 1)
+        self.assertEqual(properties.headers[ROUTING_KEY], 'product_liked.1')
+        self.assertEqual(properties.headers[ERROR], 'RuntimeError: boom')
+        self.assertIsInstance(properties.headers[FAILED_AT], int)
+        self.assertEqual(self.channel.acked, [1])
+        self.assertNotIn(1, self.lane.messages)
+
+    def test_keeps_the_first_routing_key_across_retries(self):
+        self.reject(1, routing_key='admin.product_liked.0', headers={ATTEMPTS: 1, ROUTING_KEY: 'product_liked.1'})
+        (_, properties, _), = self.channel.queues['admin.product_liked.0.retry.1']
+        self.assertEqual(properties.headers[ATTEMPTS], 2)
+        self.assertEqual(properties.headers[ROUTING_KEY], 'product_liked.1')
+
+    def test_dead_letters_after_the_last_retry(self):
+        self.reject(1, headers={ATTEMPTS: 2, ROUTING_KEY: 'product_liked.1'})
+        self.assertEqual(len(self.channel.queues['admin.product_liked.dead']), 1)
+
+    def test_dead_letters_unreadable_messages_without_retrying(self):
+        self.reject(1, retry=False)
+        (_, properties, _), = self.channel.queues['admin.product_liked.dead']
+        self.assertNotIn(ATTEMPTS, properties.headers)
+
+    def test_raises_without_a_dead_letter_queue(self):
+        lane = Lane('product_liked', 'admin.product_liked.0', self.channel)
+        lane.messages[1] = ('product_liked.1', *message(1))
+        with self.assertRaises(RuntimeError):
+            lane.reject(1, RuntimeError('boom'))
+
+
+class FlushLaneTests(SimpleTestCase):
+    def setUp(self):
+        self.channel = FakeChannel()
+        self.lane = make_lane(self.channel)
+        self.applied = []
+
+    def flush(self, channel, batch, queue, lag=0):
+        ids = [events[0][1]['id'] for _, _, events in batch]
+        if 13 in ids:
+            raise ValueError('bad product')
+        self.applied.extend(ids)
+        channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+        batch.clear()
+
+    def test_flushes_the_batch_at_once(self):
+        for tag in (1, 2, 3):
+            add_to_batch(self.lane, tag, tag)
+        flush_lane(self.lane, self.flush)
+        self.assertEqual(self.applied, [1, 2, 3])
+        self.assertEqual(self.lane.messages, {})
+        self.assertEqual(self.channel.queues['admin.product_liked.0.retry.0'], deque())
+
+    def test_isolates_a_poison_message(self):
+        for tag, product_id in ((1, 1), (2, 13), (3, 3)):
+            add_to_batch(self.lane, tag, product_id)
+        flush_lane(self.lane, self.flush)
+        self.assertEqual(self.applied, [1, 3])
+        (routing_key, properties, _), = self.channel.queues['admin.product_liked.0.retry.0']
+        self.assertEqual(properties.headers[ROUTING_KEY], 'product_liked.1')
+        self.assertIn('bad product', properties.headers[ERROR])
+        # the poison message is rejected before anything after it is acked
+        self.assertEqual(self.channel.acked, [1, 2, 3])
+        self.assertEqual(self.lane.batch, [])
+        self.assertEqual(self.lane.messages, {})
+
+
+class ConsumeLanesTests(SimpleTestCase):
+    def read(self, properties, body):
+        return None, decode(properties.content_type, body), (properties.headers or {}).get(PUBLISHED_AT)
+
+    def consume(self, *messages):
+        channel = FakeChannel()
+        lane = make_lane(channel)
+        for properties, body in messages:
+            channel.queues[lane.queue].append(('product_liked.1', properties, body))
+        applied = []
+
+        def flush(channel, batch, queue, lag=0):
+            applied.extend(events[0][1]['id'] for _, _, events in batch)
+            channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+            batch.clear()
+
+        stopping = Event()
+        stopping.set()
+        consume_lanes(channel, [lane], self.read, flush, batch_size=10, batch_timeout=0, stopping=stopping)
+        return channel, applied
+
+    def test_dead_letters_messages_it_cannot_read(self):
+        channel, applied = self.consume(
+            message(1),
+            (pika.BasicProperties(content_type=JSON), b'[1,2]'),
+            (pika.BasicProperties(content_type=JSON), b'{"v":1}'),
+            message(2),
+        )
+        self.assertEqual(applied, [1, 2])
+        self.assertEqual(len(channel.queues['admin.product_liked.dead']), 2)
+
+    def test_ignores_an_unreadable_publish_time(self):
+        channel, applied = self.consume(message(1, {PUBLISHED_AT: 'yesterday'}), message(2, {PUBLISHED_AT: 5}))
+        self.assertEqual(applied, [1, 2])
+        self.assertEqual(channel.queues['admin.product_liked.dead'], deque())
+
+
+class TopologyTests(SimpleTestCase):
+    def test_keeps_a_products_events_on_one_partition_of_one_stream(self):
+        keys = {routing_key(event_type, product_key({'id': 70})) for event_type in
+                ('product_created', 'product_updated', 'product_deleted')}
+        self.assertEqual(keys, {f'products.{70 % event_partitions}'})
+        self.assertEqual(product_key(70), product_key({'id': 70}))
+        self.assertEqual(routing_key('product_liked', '6'), 'product_liked.6')
+
+    def test_declares_sharded_queues_with_retries_and_a_dead_letter_queue(self):
+        channel = mock.Mock()
+        with mock.patch('products.topology.retry_delays', [1, 10]):
+            declare_topology(channel, 'admin', ['products'], 2)
+        queues = [call.kwargs['queue'] for call in channel.queue_declare.call_args_list]
+        self.assertEqual(queues, [
+            'admin.products.0', 'admin.products.0.retry.1s', 'admin.products.0.retry.10s',
+            'admin.products.1', 'admin.products.1.retry.1s', 'admin.products.1.retry.10s',
+            'admin.products.dead',
+        ])
+        retry = channel.queue_declare.call_args_list[2].kwargs['arguments']
+        self.assertEqual(retry, {'x-message-ttl': 10000, 'x-dead-letter-exchange': '',
+                                 'x-dead-letter-routing-key': 'admin.products.0'})
+        channel.exchange_bind.assert_called_once_with(
+            destination='admin.products', source='admin.events', routing_key='products.*'
+        )
+
+    def test_flushes_higher_priority_lanes_first(self):
+        channels = [FakeChannel(), FakeChannel()]
+        likes = Lane('product_liked', 'admin.product_liked.0', channels[0], priority=1)
+        products = Lane('products', 'admin.products.0', channels[1], priority=2)
+        for lane in (likes, products):
+            lane.channel.queues[lane.queue].append(('product_liked.1', *message(1)))
+        connection = SimpleNamespace(
+            process_data_events=lambda time_limit=0: [channel.process_data_events() for channel in channels]
+        )
+        flushed = []
+
+        def flush(channel, batch, queue, lag=0):
+            flushed.append(queue)
+            batch.clear()
+
+        stopping = Event()
+        stopping.set()
+        consume_lanes(connection, [likes, products], lambda properties, body: (None, [], None), flush,
+                      batch_size=10, batch_timeout=0, stopping=stopping)
+        self.assertEqual(flushed, ['admin.products.0', 'admin.product_liked.0'])
+
+
+class ReplayDeadLettersTests(SimpleTestCase):
+    queue = 'admin.product_liked.dead'
+
+    def dead_letter(self, channel, product_id, headers):
+        properties, body = message(product_id, headers)
+        channel.basic_publish(exchange='', routing_key=self.queue, body=body, properties=properties)
+
+    def test_replays_with_the_original_routing_key_and_fresh_retries(self):
+        channel = FakeChannel(routes={'admin.events': 'replayed'})
+        self.dead_letter(channel, 1, {ROUTING_KEY: 'product_liked.1', ATTEMPTS: 5, ERROR: 'boom', FAILED_AT: 1})
+        self.assertEqual(replay_dead_letters(channel, self.queue, 'admin.events'), (1, 0))
+        (routing_key, properties, _), = channel.queues['replayed']
+        self.assertEqual(routing_key, 'product_liked.1')
+        self.assertEqual(properties.headers, {})
+
+    def test_stops_at_the_messages_queued_when_it_started(self):
+        # a consumer that fails them again sends them straight back to the dead letter queue
+        channel = FakeChannel(routes={'admin.events': self.queue})
+        for product_id in (1, 2, 3):
+            self.dead_letter(channel, product_id, {ROUTING_KEY: 'product_liked.1'})
+        self.assertEqual(replay_dead_letters(channel, self.queue, 'admin.events'), (3, 0))
+        self.assertEqual(len(channel.queues[self.queue]), 3)
+
+    def test_honours_the_limit(self):
+        channel = FakeChannel(routes={'admin.events': 'replayed'})
+        for product_id in (1, 2, 3):
+            self.dead_letter(channel, product_id, {ROUTING_KEY: 'product_liked.1'})
+        self.assertEqual(replay_dead_letters(channel, self.queue, 'admin.events', limit=2), (2, 0))
+        self.assertEqual(len(channel.queues[self.queue]), 1)
+
+    def test_moves_messages_without_a_routing_key_to_the_back(self):
+        channel = FakeChannel(routes={'admin.events': 'replayed'})
+        self.dead_letter(channel, 1, {})
+        self.dead_letter(channel, 2, {ROUTING_KEY: 'product_liked.1'})
+        self.assertEqual(replay_dead_letters(channel, self.queue, 'admin.events'), (1, 1))
+        self.assertEqual(len(channel.queues['replayed']), 1)
+        self.assertEqual(len(channel.queues[self.queue]), 1)
+
+
+class SupervisorTests(SimpleTestCase):
+    def test_spreads_every_shard_over_the_workers_once(self):
+        shards = [shard for index in range(3) for shard in runner.worker_shards(index, workers=3, shards=8)]
+        self.assertEqual(sorted(shards), list(range(8)))
+
+    def test_backs_off_while_a_worker_keeps_dying(self):
+        with mock.patch.object(runner, 'restart_min_delay', 1), mock.patch.object(runner, 'restart_max_delay', 60):
+            delays = [0]
+            for _ in range(8):
+                delays.append(runner.restart_delay(delays[-1], ran_for=0.5))
+            self.assertEqual(delays[1:], [1, 2, 4, 8, 16, 32, 60, 60])
+            # a worker that ran for a while starts over
+            self.assertEqual(runner.restart_delay(60, ran_for=300), 1)
+
+    def test_exits_quietly_when_another_consumer_holds_the_shards(self):
+        refused = pika.exceptions.ChannelClosedByBroker(403, "ACCESS_REFUSED - queue 'admin.products.0' in exclusive use")
+        with mock.patch.object(runner.signal, 'signal'):
+            with self.assertRaises(SystemExit):
+                runner._worker(mock.Mock(side_effect=refused), 0, Event())
+            with self.assertRaises(pika.exceptions.ChannelClosedByBroker):
+                runner._worker(mock.Mock(side_effect=pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND')), 0, Event())
+
+
+class LikeBatchTests(TestCase):
+    def setUp(self):
+        import consumer
+        self.consumer = consumer
+        self.products = [Product.objects.create(title=f'product {n}', image=f'{n}.png') for n in range(2)]
+        self.channel = FakeChannel()
+
+    def batch(self):
+        first, second = self.products
+        return [
+            (1, None, [('product_liked', {'id': first.id})]),
+            (2, None, [('product_likes', {str(first.id): 2, str(second.id): 5})]),
+            (3, None, [('product_liked', {'id': second.id}), ('product_unknown', {})]),
+        ]
+
+    def test_counts_single_likes_and_deltas(self):
+        first, second = self.products
+        events = [event for _, _, message_events in self.batch() for event in message_events]
+        self.assertEqual(self.consumer.count_likes(events), {first.id: 3, second.id: 6})
+
+    def test_applies_the_batch_and_acks_it_once(self):
+        batch = self.batch()
+        self.consumer.flush(self.channel, batch, 'admin.product_liked.0')
+        self.assertEqual(sorted(Product.objects.values_list('likes', flat=True)), [3, 6])
+        self.assertEqual(self.channel.acked, [3])
+        self.assertEqual(batch, [])
+
+    def test_acks_nothing_when_the_batch_fails(self):
+        batch = self.batch()
+        with mock.patch.object(self.consumer, 'increment_likes', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                self.consumer.flush(self.channel, batch, 'admin.product_liked.0')
+        self.assertEqual(self.channel.acked, [])
+        self.assertEqual(len(batch), 3)
+
+
+class LikeShardingTests(TestCase):
+    def setUp(self):
+        self.cold, self.hot = [Product.objects.create(title=f'product {n}', image=f'{n}.png') for n in range(2)]
+
+    def likes(self):
+        return {product.id: product.total_likes for product in Product.objects.with_likes()}
+
+    def test_spots_products_liked_faster_than_the_threshold(self):
+        now = [0.0]
+        with mock.patch('products.likes.time.monotonic', lambda: now[0]):
+            hot = HotProducts(threshold=10, window=5)
+            hot.record({1: 40, 2: 60})
+            self.assertNotIn(2, hot)
+            now[0] = 5
+            hot.record({2: 1})
+            self.assertEqual(hot.hot, {2})
+            now[0] = 10
+            hot.record({1: 1})
+            self.assertEqual(hot.hot, set())
+
+    def test_counts_hot_products_on_the_workers_shard_row(self):
+        increment_likes({self.cold.id: 2, self.hot.id: 3}, shard=1, hot={self.hot.id})
+        increment_likes({self.hot.id: 4}, shard=1, hot={self.hot.id})
+        increment_likes({self.hot.id: 5}, shard=2, hot={self.hot.id})
+        self.assertEqual(Product.objects.get(id=self.hot.id).likes, 0)
+        self.assertEqual(dict(LikeShard.objects.values_list('shard', 'likes')), {1: 7, 2: 5})
+        self.assertEqual(self.likes(), {self.cold.id: 2, self.hot.id: 12})
+
+    def test_skips_products_that_no_longer_exist(self):
+        increment_likes({0: 3, self.cold.id: 1}, shard=1, hot={0})
+        self.assertFalse(LikeShard.objects.exists())
+        self.assertEqual(self.likes()[self.cold.id], 1)
+
+    def test_compacts_a_shard_back_into_the_product(self):
+        increment_likes({self.hot.id: 3}, shard=1, hot={self.hot.id})
+        increment_likes({self.hot.id: 5}, shard=2, hot={self.hot.id})
+        self.assertEqual(compact_likes(1), 3)
+        self.assertEqual(compact_likes(1), 0)
+        self.assertEqual(Product.objects.get(id=self.hot.id).likes, 3)
+        self.assertEqual(self.likes()[self.hot.id], 8)
+
+
+class ProductCacheTests(TestCase):
+    def setUp(self):
+        import consumer
+        self.consumer = consumer
+        caches['products'].clear()
+        product_cache._version = None
+        self.addCleanup(setattr, product_cache, '_version', None)
+        self.product = Product.objects.create(title='a', image='a.png')
+        self.client = APIClient()
+        self.now = 1000.0
+        patcher = mock.patch('products.cache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self):
+        return self.client.get(f'/api/products/{self.product.id}').data
+
+    def test_serves_payloads_from_the_cache(self):
+        self.get()
+        Product.objects.filter(id=self.product.id).update(title='renamed')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get()['title'], 'a')
+
+    def test_product_writes_bump_the_version(self):
+        self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/api/products/{self.product.id}', {'title': 'b', 'image': 'b.png'}, format='json')
+        self.assertEqual(self.get()['title'], 'b')
+
+    def test_likes_show_up_with_the_next_window_without_a_version_bump(self):
+        self.get()
+        version = list(CatalogueVersion.objects.values_list('version', flat=True))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.consumer.apply_likes({self.product.id: 3})
+        self.assertEqual(callbacks, [])
+        self.assertEqual(list(CatalogueVersion.objects.values_list('version', flat=True)), version)
+        self.assertEqual(self.get()['likes'], 0)
+
+        self.now += product_cache.likes_max_age
+        self.assertEqual(self.get()['likes'], 3)
+
+
+class StreamingListTests(TestCase):
+    def setUp(self):
+        caches['products'].clear()
+        for n in range(5):
+            Product.objects.create(title=f'product {n}', image=f'{n}.png', likes=n)
+        self.client = APIClient()
+
+    def test_streams_the_same_products_as_the_cached_list(self):
+        response = self.client.get('/api/products?stream=1')
+        self.assertTrue(response.streaming)
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), self.client.get('/api/products').json())
+
+    def test_emits_a_valid_array_at_every_chunk_size(self):
+        for chunk_size in (1, 2, 5, 100):
+            with self.subTest(chunk_size=chunk_size):
+                chunks = list(stream_products(chunk_size))
+                self.assertEqual([row['likes'] for row in json.loads(''.join(chunks))], [0, 1, 2, 3, 4])
+        self.assertEqual(''.join(stream_products(2, Product.objects.none())), '[]')
+
+
+class BulkEndpointTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def items(self, count):
+        return [{'title': f'product {n}', 'image': f'{n}.png'} for n in range(count)]
+
+    def test_creates_products_and_their_events_in_chunks(self):
+        with mock.patch('products.views.products_bulk_chunk_size', 2):
+            response = self.client.post('/api/products/bulk', self.items(5), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len({product['id'] for product in response.data}), 5)
+        self.assertEqual(Product.objects.count(), 5)
+        self.assertEqual(OutboxEvent.objects.filter(event_type='product_created').count(), 5)
+
+    def test_caps_the_items_per_request(self):
+        with mock.patch('products.views.products_bulk_max_items', 3):
+            self.assertEqual(self.client.post('/api/products/bulk', self.items(4), format='json').status_code, 400)
+            self.assertEqual(self.client.delete('/api/products/bulk', {'ids': [1, 2, 3, 4]}, format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/products/bulk', [], format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/products/bulk', {'title': 'a'}, format='json').status_code, 400)
+        self.assertFalse(Product.objects.exists())
+
+    def test_the_default_cap_is_10000_items(self):
+        self.assertEqual(self.client.post('/api/products/bulk', self.items(10001), format='json').status_code, 400)
+
+    def test_updates_all_products_or_none(self):
+        ids = [item['id'] for item in self.client.post('/api/products/bulk', self.items(2), format='json').data]
+        response = self.client.put('/api/products/bulk', [
+            {'id': ids[0], 'title': 'a', 'image': 'a.png'}, {'id': 0, 'title': 'b', 'image': 'b.png'},
+        ], format='json')
+        self.assertEqual((response.status_code, response.data['ids']), (404, [0]))
+
+        response = self.client.put('/api/products/bulk', [
+            {'id': ids[0], 'title': 'a', 'image': 'a.png'}, {'id': ids[1], 'title': 'b', 'image': 'b.png'},
+        ], format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(list(Product.objects.order_by('id').values_list('title', flat=True)), ['a', 'b'])
+        self.assertEqual(OutboxEvent.objects.filter(event_type='product_updated').count(), 2)
+
+    def test_deletes_the_products_that_exist(self):
+        ids = [item['id'] for item in self.client.post('/api/products/bulk', self.items(3), format='json').data]
+        response = self.client.delete('/api/products/bulk', {'ids': ids[:2] + [0]}, format='json')
+        self.assertEqual(response.data, {'deleted': 2})
+        self.assertEqual(list(Product.objects.values_list('id', flat=True)), ids[2:])
+        self.assertEqual(OutboxEvent.objects.filter(event_type='product_deleted').count(), 2)
+        self.assertEqual(self.client.delete('/api/products/bulk', {'ids': ['x']}, format='json').status_code, 400)
+
+
+class ReconcileEndpointTests(TestCase):
+    def setUp(self):
+        self.products = [Product.objects.create(title=f'product {n}', image=f'{n}.png') for n in range(5)]
+        self.client = APIClient()
+
+    def test_checksums_the_products_in_id_buckets(self):
+        rows = [(product.id, product.title, product.image) for product in self.products]
+        response = self.client.get('/api/products/checksums?bucket_size=2')
+        self.assertEqual(response.json()['buckets'], {str(k): v for k, v in checksum_buckets(rows, 2).items()})
+        self.assertEqual(self.client.get('/api/products/checksums?bucket_size=0').status_code, 400)
+
+    def test_exports_the_products_in_a_range(self):
+        first = self.products[0].id
+        response = self.client.get(f'/api/products/export?after={first}&until={first + 2}')
+        self.assertEqual([row['id'] for row in json.loads(b''.join(response.streaming_content))], [first + 1, first + 2])
+        self.assertEqual(self.client.get('/api/products/export?after=x').status_code, 400)
+
+
+class UserLookupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.ids = [User.objects.create(username=f'user{n}').id for n in range(5)]
+        self.client = APIClient()
+
+    def test_picks_an_existing_user(self):
+        for _ in range(20):
+            self.assertIn(self.client.get('/api/user').data['id'], self.ids)
+
+    def test_answers_404_without_users(self):
+        User.objects.all().delete()
+        self.assertEqual(self.client.get('/api/user').status_code, 404)
+
+    def test_caches_the_id_bounds_until_users_change(self):
+        self.assertEqual(user_id_bounds(), (self.ids[0], self.ids[-1]))
+        with self.assertNumQueries(0):
+            user_id_bounds()
+        User.objects.filter(id=self.ids[-1]).first().delete()
+        self.assertEqual(user_id_bounds(), (self.ids[0], self.ids[-2]))
+
+    def test_returns_a_window_of_ids_wrapping_around_the_end(self):
+        with mock.patch('products.views.random.randint', return_value=self.ids[3]):
+            ids = self.client.get('/api/users/ids?limit=3').data['ids']
+        self.assertEqual(ids, [self.ids[3], self.ids[4], self.ids[0]])
+
+    def test_clamps_the_limit(self):
+        self.assertEqual(len(self.client.get('/api/users/ids?limit=-5').data['ids']), 1)
+        self.assertEqual(len(self.client.get('/api/users/ids?limit=0').data['ids']), 1)
+        self.assertEqual(self.client.get('/api/users/ids?limit=lots').status_code, 400)
+
+
+class OutboxRelayTests(TestCase):
+    def setUp(self):
+        import relay
+        self.relay = relay
+        patcher = mock.patch.object(relay, 'publisher')
+        self.publisher = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def published(self):
+        return [
+            (routing_key, decode(properties.content_type, body))
+            for (properties, body, routing_key), _ in self.publisher.publish.call_args_list
+        ]
+
+    def test_records_the_event_with_the_product_change(self):
+        product_id = self.client.post('/api/products', {'title': 'a', 'image': 'a.png'}, format='json').data['id']
+        self.client.put(f'/api/products/{product_id}', {'title': 'b', 'image': 'b.png'}, format='json')
+        self.assertEqual(
+            [(event.event_type, event.payload['title']) for event in OutboxEvent.objects.order_by('id')],
+            [('product_created', 'a'), ('product_updated', 'b')]
+        )
+
+    def test_records_nothing_when_the_change_rolls_back(self):
+        with mock.patch('products.views.publish_event', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/api/products', {'title': 'a', 'image': 'a.png'}, format='json')
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_publishes_a_products_events_together_in_order_and_clears_them(self):
+        publish_event('product_created', {'id': 1, 'title': 'a', 'image': 'a.png', 'likes': 0})
+        publish_event('product_created', {'id': 2, 'title': 'b', 'image': 'b.png', 'likes': 0})
+        publish_event('product_deleted', {'id': 1})
+        self.assertEqual(self.relay.relay_batch(), 3)
+
+        (first_key, first), (second_key, second) = self.published()
+        self.assertEqual((first_key, second_key), ('products.1', 'products.2'))
+        self.assertEqual([event_type for event_type, _ in first], ['product_created', 'product_deleted'])
+        self.assertEqual([event_type for event_type, _ in second], ['product_created'])
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(self.relay.relay_batch(), 0)
+
+    def test_versions_events_with_their_outbox_id(self):
+        publish_event('product_created', {'id': 1, 'title': 'a', 'image': 'a.png', 'likes': 0})
+        publish_event('product_deleted', 1)
+        ids = list(OutboxEvent.objects.order_by('id').values_list('id', flat=True))
+        self.relay.relay_batch()
+
+        [(_, events)] = self.published()
+        self.assertEqual([data['version'] for _, data in events], ids)
+        self.assertEqual(events[1][1], {'id': 1, 'version': ids[1]})
+
+    def test_keeps_the_events_when_publishing_fails(self):
+        publish_event('product_deleted', {'id': 1})
+        self.publisher.publish.side_effect = pika.exceptions.AMQPError('broker down')
+        with self.assertRaises(pika.exceptions.AMQPError):
+            self.relay.relay_batch()
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+
+class FakeCursor:
+    def __init__(self, columns, row):
+        self.description = [(column,) for column in columns]
+        self.row = row
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def fetchone(self):
+        return self.row
+
+
+class ReplicaLagTests(SimpleTestCase):
+    def measure(self, vendor, columns, row):
+        cursor = FakeCursor(columns, row)
+        return replica.measure_lag(SimpleNamespace(vendor=vendor, cursor=lambda: cursor))
+
+    def test_reads_a_postgresql_standbys_lag(self):
+        self.assertEqual(self.measure('postgresql', ['lag'], (2,)), 2.0)
+
+    def test_a_postgresql_standby_without_a_streaming_wal_receiver_is_broken(self):
+        self.assertIn('pg_stat_wal_receiver', replica.POSTGRESQL_LAG)
+        self.assertIsNone(self.measure('postgresql', ['lag'], (None,)))
+
+    def test_reads_a_mysql_replicas_lag(self):
+        columns = ['Replica_IO_Running', 'Seconds_Behind_Source']
+        self.assertEqual(self.measure('mysql', columns, ('Yes', 3)), 3.0)
+        self.assertEqual(self.measure('mysql', columns, None), 0.0)
+
+    def test_a_mysql_replica_that_lost_the_source_is_broken(self):
+        columns = ['Replica_IO_Running', 'Seconds_Behind_Source']
+        self.assertIsNone(self.measure('mysql', columns, ('Connecting', 0)))
+
+    def test_checks_at_most_once_per_interval(self):
+        lag = replica.ReplicaLag('default', interval=60)
+        with mock.patch.object(replica, 'measure_lag', return_value=1.0) as measure_lag:
+            self.assertTrue(lag.healthy(max_lag=5))
+            self.assertTrue(lag.healthy(max_lag=5))
+        self.assertEqual(measure_lag.call_count, 1)
+
+    def test_is_unhealthy_when_behind_broken_or_unreadable(self):
+        for side_effect in ([10.0], [None], RuntimeError('replica down')):
+            lag = replica.ReplicaLag('default', interval=60)
+            with mock.patch.object(replica, 'measure_lag', side_effect=side_effect):
+                self.assertFalse(lag.healthy(max_lag=5))
+        self.assertEqual(replica.replica_lag_seconds._value.get(), -1)
+
+
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        self.router = replica.ReplicaRouter()
+        self.factory = RequestFactory()
+        patcher = mock.patch.object(replica.replica_lag, 'healthy', return_value=True)
+        self.healthy = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_go_to_the_replica_and_writes_to_the_primary(self):
+        self.assertEqual(self.router.db_for_read(Product), replica.REPLICA)
+        self.assertEqual(self.router.db_for_write(Product), 'default')
+        self.assertFalse(self.router.allow_migrate(replica.REPLICA, 'products'))
+
+    def test_reads_go_to_the_primary_while_the_replica_is_unhealthy(self):
+        self.healthy.return_value = False
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_reads_go_to_the_primary_inside_use_primary(self):
+        with replica.use_primary():
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+        self.assertEqual(self.router.db_for_read(Product), replica.REPLICA)
+
+    def respond(self, request, status=200):
+        seen = []
+
+        def view(request):
+            seen.append(self.router.db_for_read(Product))
+            return HttpResponse(status=status)
+
+        response = replica.ReplicaPinningMiddleware(view)(request)
+        return seen[0], response
+
+    def test_pins_a_write_and_the_clients_reads_after_it(self):
+        read_db, response = self.respond(self.factory.post('/api/products'))
+        self.assertEqual(read_db, 'default')
+        self.assertIn(replica.PIN_COOKIE, response.cookies)
+
+        request = self.factory.get('/api/products')
+        request.COOKIES[replica.PIN_COOKIE] = '1'
+        self.assertEqual(self.respond(request)[0], 'default')
+
+    def test_leaves_other_reads_on_the_replica(self):
+        read_db, response = self.respond(self.factory.get('/api/products'))
+        self.assertEqual(read_db, replica.REPLICA)
+        self.assertNotIn(replica.PIN_COOKIE, response.cookies)
+
+    def test_does_not_pin_after_a_failed_write(self):
+        _, response = self.respond(self.factory.post('/api/products'), status=400)
+        self.assertNotIn(replica.PIN_COOKIE, response.cookies)
@@ -1,16 +1,28 @@
 from django.urls import path
 
-from .views import ProductViewSet, UserAPIView
+from .views import ProductViewSet, UserAPIView, UserIdsAPIView
 
 urlpatterns = [
     path('products', ProductViewSet.as_view({
         'get': 'list',
         'post': 'create'
     })),
+    path('products/bulk', ProductViewSet.as_view({
+        'post': 'bulk_create',
+        'put': 'bulk_update',
+        'delete': 'bulk_destroy'
+    })),
+    path('products/checksums', ProductViewSet.as_view({
+        'get': 'checksums'
+    })),
+    path('products/export', ProductViewSet.as_view({
+        'get': 'export'
+    })),
     path('products/<str:pk>', ProductViewSet.as_view({
         'get': 'retrieve',
         'put': 'update',
         'delete': 'destroy'
     })),
-    path('user', UserAPIView.as_view())
+    path('user', UserAPIView.as_view()),
+    path('users/ids', UserIdsAPIView.as_view())
 ]
@@ -0,0 +1,49 @@
+import os
+import random
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Max, Min
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+USER_ID_BOUNDS_KEY = 'products:user_id_bounds'
+user_id_bounds_ttl = int(os.environ.get("USER_ID_BOUNDS_TTL", "60"))
+
+
+def user_id_bounds():
+    """
+    (lowest, highest) user id, cached so that picking a user costs a single
+    indexed lookup instead of loading the table.
+    """
+    bounds = cache.get(USER_ID_BOUNDS_KEY)
+    if bounds is None:
+        aggregate = User.objects.aggregate(low=Min('id'), high=Max('id'))
+        bounds = (aggregate['low'], aggregate['high'])
+        cache.set(USER_ID_BOUNDS_KEY, bounds, user_id_bounds_ttl)
+    return bounds
+
+
+def random_user_id():
+    """
+    Picks a random user id by probing the primary key index at a random
+    point between the cached bounds. Ids right after a gap are slightly
+    more likely to be picked, which is fine for choosing a liker.
+    """
+    low, high = user_id_bounds()
+    if low is None:
+        return None
+
+    users = User.objects.order_by('id').values_list('id', flat=True)
+    user_id = users.filter(id__gte=random.randint(low, high)).first()
+    if user_id is None:
+        # users above the cached upper bound were deleted by another process
+        cache.delete(USER_ID_BOUNDS_KEY)
+        user_id = users.first()
+    return user_id
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def reset_user_id_bounds(**kwargs):
+    cache.delete(USER_ID_BOUNDS_KEY)
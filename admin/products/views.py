@@ -2,10 +2,17 @@ from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.contrib.auth.models import User
+from django.db import connection, router, transaction
+from django.http import StreamingHttpResponse
 
+from .cache import product_cache
+from .checksums import checksum_buckets
 from .models import Product
-from .producer import publish
+from .outbox import publish_event, publish_events
 from .serializers import ProductSerializer
+from .users import random_user_id, user_id_bounds
+import json
+import os
 import random
 
 from opentelemetry import trace
@@ -14,34 +21,94 @@ from opentelemetry.trace.status import Status, StatusCode
 # Initialize tracer
 tracer = trace.get_tracer(__name__)
 
+products_stream_chunk_size = int(os.environ.get("PRODUCTS_STREAM_CHUNK_SIZE", "2000"))
+products_bulk_chunk_size = int(os.environ.get("PRODUCTS_BULK_CHUNK_SIZE", "1000"))
+products_bulk_max_items = int(os.environ.get("PRODUCTS_BULK_MAX_ITEMS", "10000"))
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def bulk_error(items):
+    """A 400 response when items is not a list the bulk endpoints accept, else None."""
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'Expected a non-empty list'}, status=400)
+    if len(items) > products_bulk_max_items:
+        return Response({'error': f'At most {products_bulk_max_items} items per request'}, status=400)
+    return None
+
+
+def stream_products(chunk_size, products=None):
+    """
+    Yields every product as a JSON array, a chunk of rows at a time. values()
+    rows are read off the cursor with iterator(), so no Product instances or
+    serializer are involved and the full list is never held in memory.
+    """
+    products = Product.objects.all() if products is None else products
+    # picks the database now, the response is iterated after the request's routing has been undone
+    products = products.using(router.db_for_read(Product))
+    rows = products.with_likes().order_by('id').values('id', 'title', 'image', 'total_likes') \
+        .iterator(chunk_size=chunk_size)
+    return json_array(rows, chunk_size)
+
+
+def json_array(rows, chunk_size):
+    yield '['
+    separator, chunk = '', []
+    for row in rows:
+        row['likes'] = row.pop('total_likes')
+        chunk.append(json.dumps(row, separators=(',', ':')))
+        if len(chunk) == chunk_size:
+            yield separator + ','.join(chunk)
+            separator, chunk = ',', []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield ']'
+
+
 class ProductViewSet(viewsets.ViewSet):
     def list(self, request):
         with tracer.start_as_current_span("list_products") as span:
-            products = Product.objects.all()
-            span.set_attribute("products.count", products.count())
-            serializer = ProductSerializer(products, many=True)
-            return Response(serializer.data)
+            # ?stream=1 skips the cache and streams the catalogue straight from the db
+            if request.query_params.get('stream', '').lower() in ('1', 'true'):
+                span.set_attribute("products.stream", True)
+                return StreamingHttpResponse(
+                    stream_products(products_stream_chunk_size), content_type='application/json'
+                )
+
+            data, hit = product_cache.get_or_load(
+                'list', lambda: ProductSerializer(Product.objects.with_likes(), many=True).data
+            )
+            span.set_attribute("products.count", len(data))
+            span.set_attribute("cache.hit", hit)
+            return Response(data)
 
     def create(self, request):
         with tracer.start_as_current_span("create_product") as span:
             serializer = ProductSerializer(data=request.data)
             serializer.is_valid(raise_exception=True)
-            serializer.save()
+            with transaction.atomic():
+                serializer.save()
+                product_data = serializer.data
+                publish_event('product_created', product_data)
+                product_cache.invalidate()
 
-            product_data = serializer.data
             span.set_attribute("product.id", product_data.get("id"))
             span.set_attribute("product.title", product_data.get("title"))
 
-            publish('product_created', product_data)
             return Response(product_data, status=status.HTTP_201_CREATED)
 
     def retrieve(self, request, pk=None):
         with tracer.start_as_current_span("retrieve_product") as span:
             try:
-                product = Product.objects.get(id=pk)
-                span.set_attribute("product.id", product.id)
-                serializer = ProductSerializer(product)
-                return Response(serializer.data)
+                data, hit = product_cache.get_or_load(
+                    f'product:{pk}', lambda: ProductSerializer(Product.objects.with_likes().get(id=pk)).data
+                )
+                span.set_attribute("product.id", data['id'])
+                span.set_attribute("cache.hit", hit)
+                return Response(data)
             except Product.DoesNotExist:
                 span.set_status(Status(StatusCode.ERROR, "Product not found"))
                 return Response({"error": "Product not found"}, status=404)
@@ -52,13 +119,15 @@ class ProductViewSet(viewsets.ViewSet):
                 product = Product.objects.get(id=pk)
                 serializer = ProductSerializer(instance=product, data=request.data)
                 serializer.is_valid(raise_exception=True)
-                serializer.save()
+                with transaction.atomic():
+                    serializer.save()
+                    updated_data = serializer.data
+                    publish_event('product_updated', updated_data)
+                    product_cache.invalidate()
 
-                updated_data = serializer.data
                 span.set_attribute("product.id", updated_data.get("id"))
                 span.set_attribute("product.title", updated_data.get("title"))
 
-                publish('product_updated', updated_data)
                 return Response(updated_data, status=status.HTTP_202_ACCEPTED)
             except Product.DoesNotExist:
                 span.set_status(Status(StatusCode.ERROR, "Product not found"))
@@ -68,28 +137,171 @@ class ProductViewSet(viewsets.ViewSet):
         with tracer.start_as_current_span("delete_product") as span:
             try:
                 product = Product.objects.get(id=pk)
-                product.delete()
+                with transaction.atomic():
+                    product.delete()
+                    publish_event('product_deleted', {'id': int(pk)})
+                    product_cache.invalidate()
                 span.set_attribute("product.id", pk)
-                publish('product_deleted', pk)
                 return Response(status=status.HTTP_204_NO_CONTENT)
             except Product.DoesNotExist:
                 span.set_status(Status(StatusCode.ERROR, "Product not found"))
                 return Response({"error": "Product not found"}, status=404)
 
 
+    def bulk_create(self, request):
+        """Creates a list of products with one INSERT and one outbox INSERT per chunk."""
+        with tracer.start_as_current_span("bulk_create_products") as span:
+            error = bulk_error(request.data)
+            if error is not None:
+                return error
+            serializer = ProductSerializer(data=request.data, many=True)
+            serializer.is_valid(raise_exception=True)
+
+            products = [Product(**item) for item in serializer.validated_data]
+            created = []
+            with transaction.atomic():
+                for chunk in chunks(products, products_bulk_chunk_size):
+                    if connection.features.can_return_rows_from_bulk_insert:
+                        Product.objects.bulk_create(chunk)
+                    else:
+                        # MySQL does not hand back the ids of a multi-row INSERT
+                        for product in chunk:
+                            product.save()
+                    data = ProductSerializer(chunk, many=True).data
+                    publish_events('product_created', data)
+                    created.extend(data)
+                product_cache.invalidate()
+
+            span.set_attribute("products.count", len(created))
+            return Response(created, status=status.HTTP_201_CREATED)
+
+    def bulk_update(self, request):
+        """Updates a list of products, each with its id, with one UPDATE per chunk."""
+        with tracer.start_as_current_span("bulk_update_products") as span:
+            error = bulk_error(request.data)
+            if error is not None:
+                return error
+            try:
+                ids = [int(item['id']) for item in request.data]
+            except (KeyError, TypeError, ValueError):
+                return Response({'error': 'Every product needs an integer id'}, status=400)
+            serializer = ProductSerializer(data=request.data, many=True)
+            serializer.is_valid(raise_exception=True)
+
+            updated = []
+            with transaction.atomic():
+                existing = Product.objects.in_bulk(ids)
+                missing = sorted(set(ids) - existing.keys())
+                if missing:
+                    span.set_status(Status(StatusCode.ERROR, "Product not found"))
+                    return Response({'error': 'Products not found', 'ids': missing}, status=404)
+
+                # later items win when an id repeats
+                for id, item in zip(ids, serializer.validated_data):
+                    for field, value in item.items():
+                        setattr(existing[id], field, value)
+                products = [existing[id] for id in dict.fromkeys(ids)]
+                fields = sorted({field for item in serializer.validated_data for field in item})
+
+                for chunk in chunks(products, products_bulk_chunk_size):
+                    Product.objects.bulk_update(chunk, fields)
+                    data = ProductSerializer(chunk, many=True).data
+                    publish_events('product_updated', data)
+                    updated.extend(data)
+                product_cache.invalidate()
+
+            span.set_attribute("products.count", len(updated))
+            return Response(updated, status=status.HTTP_202_ACCEPTED)
+
+    def bulk_destroy(self, request):
+        """Deletes {"ids": [...]} with one DELETE ... WHERE id IN (...) per chunk."""
+        with tracer.start_as_current_span("bulk_delete_products") as span:
+            ids = request.data.get('ids') if isinstance(request.data, dict) else None
+            error = bulk_error(ids)
+            if error is not None:
+                return error
+            if not all(isinstance(id, int) for id in ids):
+                return Response({'error': 'ids must be integers'}, status=400)
+
+            with transaction.atomic():
+                deleted = list(Product.objects.filter(id__in=ids).values_list('id', flat=True))
+                for chunk in chunks(deleted, products_bulk_chunk_size):
+                    Product.objects.filter(id__in=chunk).delete()
+                    publish_events('product_deleted', [{'id': id} for id in chunk])
+                product_cache.invalidate()
+
+            span.set_attribute("products.count", len(deleted))
+            return Response({'deleted': len(deleted)})
+
+    def checksums(self, request):
+        """Per id bucket row counts and checksums, compared against by main/reconcile.py."""
+        with tracer.start_as_current_span("product_checksums") as span:
+            try:
+                bucket_size = int(request.query_params.get('bucket_size', 1000))
+            except ValueError:
+                return Response({'error': 'bucket_size must be an integer'}, status=400)
+            if not 1 <= bucket_size <= 1000000:
+                return Response({'error': 'bucket_size must be between 1 and 1000000'}, status=400)
+
+            rows = Product.objects.order_by('id').values_list('id', 'title', 'image') \
+                .iterator(chunk_size=products_stream_chunk_size)
+            buckets = checksum_buckets(rows, bucket_size)
+            span.set_attribute("products.buckets", len(buckets))
+
+            return Response({'bucket_size': bucket_size, 'buckets': buckets})
+
+    def export(self, request):
+        """Streams the products with after < id <= until, both optional."""
+        with tracer.start_as_current_span("export_products") as span:
+            products = Product.objects.all()
+            try:
+                if 'after' in request.query_params:
+                    products = products.filter(id__gt=int(request.query_params['after']))
+                if 'until' in request.query_params:
+                    products = products.filter(id__lte=int(request.query_params['until']))
+            except ValueError:
+                return Response({'error': 'after and until must be integers'}, status=400)
+
+            return StreamingHttpResponse(
+                stream_products(products_stream_chunk_size, products), content_type='application/json'
+            )
+
+
 class UserAPIView(APIView):
     def get(self, _):
         with tracer.start_as_current_span("get_random_user") as span:
-            users = User.objects.all()
-            span.set_attribute("user.count", users.count())
+            user_id = random_user_id()
 
-            if not users:
+            if user_id is None:
                 span.set_status(Status(StatusCode.ERROR, "No users found"))
                 return Response({'error': 'No users available'}, status=404)
 
-            user = random.choice(users)
-            span.set_attribute("user.id", user.id)
+            span.set_attribute("user.id", user_id)
 
             return Response({
-                'id': user.id
-            })
\ No newline at end of file
+                'id': user_id
+            })
+
+
+class UserIdsAPIView(APIView):
+    max_limit = 100000
+
+    def get(self, request):
+        with tracer.start_as_current_span("get_user_ids") as span:
+            try:
+                limit = max(1, min(int(request.query_params.get('limit', 10000)), self.max_limit))
+            except ValueError:
+                return Response({'error': 'limit must be an integer'}, status=400)
+
+            # a random window of the id index, wrapping around at the end
+            low, high = user_id_bounds()
+            if low is None:
+                return Response({'ids': []})
+            start = random.randint(low, high)
+
+            ids = list(User.objects.filter(id__gte=start).order_by('id').values_list('id', flat=True)[:limit])
+            if len(ids) < limit:
+                ids += User.objects.filter(id__lt=start).order_by('id').values_list('id', flat=True)[:limit - len(ids)]
+            span.set_attribute("user.ids", len(ids))
+
+            return Response({'ids': ids})
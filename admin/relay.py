@@ -0,0 +1,123 @@
+import pika, os, django, time
+from collections import defaultdict
+
+from opentelemetry import trace
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "admin.settings")
+os.environ.setdefault("DB_POOL_PROFILE", "consumer")
+django.setup()
+
+from django.db import close_old_connections, transaction
+
+from admin.telemetry import setup_tracing
+from products.models import OutboxEvent
+from products.producer import Publisher
+from products.events import PUBLISHED_AT, encode, publish_time, upgrade
+from products.topology import events_exchange, product_key, routing_key
+
+rabbit_mq_url = os.environ.get("RABBIT_MQ_URL")
+
+batch_size = int(os.environ.get("RELAY_BATCH_SIZE", "500"))
+poll_interval = float(os.environ.get("RELAY_POLL_INTERVAL", "0.2"))
+metrics_port = int(os.environ.get("RELAY_METRICS_PORT", "8001"))
+
+# Reuses the provider installed by admin.settings
+setup_tracing("django-service")
+
+tracer = trace.get_tracer(__name__)
+
+relayed_events = Counter('outbox_events_relayed_total', 'Outbox events confirmed by RabbitMQ', ['event_type'])
+relay_failures = Counter('outbox_relay_failures_total', 'Outbox batches that failed and will be retried')
+relay_batch_seconds = Histogram('outbox_relay_batch_seconds', 'Time to publish and clear one outbox batch')
+relay_backlog = Gauge('outbox_backlog_events', 'Outbox events waiting to be relayed')
+
+# confirms make basic_publish raise if the broker did not take the message
+publisher = Publisher(rabbit_mq_url, exchange=events_exchange('main'), confirm=True)
+
+
+def versioned(event):
+    """
+    Stamps an event with its outbox id. Every product change writes the
+    product row before its outbox row and holds that row's lock until it
+    commits, so a product's outbox ids grow in the order its changes commit.
+    The consumer uses the version to drop an event that comes back from a
+    retry queue after newer ones were applied.
+    """
+    event_type, data = upgrade(event.event_type, event.payload)
+    return event_type, {**data, 'version': event.id}
+
+
+def relay_batch():
+    """
+    Publishes the oldest outbox events and deletes them in the same
+    transaction. A crash between the two re-sends the batch, so delivery is
+    at-least-once and consumers must treat events as idempotent writes.
+    Events in the same product partition go out together as one batch
+    message, in order, on that partition's shard.
+
+    Only one relay may run. The rows stay locked until the batch is
+    published, so a second one blocks behind it rather than skipping ahead
+    and publishing a product's later events before its earlier ones.
+    """
+    with transaction.atomic():
+        events = list(OutboxEvent.objects.select_for_update().order_by('id')[:batch_size])
+        if not events:
+            return 0
+
+        by_partition = defaultdict(list)
+        for event in events:
+            by_partition[product_key(event.payload)].append(event)
+
+        with tracer.start_as_current_span("relay_outbox_batch") as span:
+            span.set_attribute("batch.events", len(events))
+            span.set_attribute("batch.messages", len(by_partition))
+            for partition, product_events in by_partition.items():
+                content_type, event_type, body = encode([versioned(event) for event in product_events])
+                # the first event's trace context stands for the message
+                properties = pika.BasicProperties(
+                    content_type=content_type,
+                    type=event_type,
+                    headers={**product_events[0].headers, PUBLISHED_AT: publish_time()}
+                )
+                publisher.publish(properties, body, routing_key(product_events[0].event_type, partition))
+
+        OutboxEvent.objects.filter(id__in=[event.id for event in events]).delete()
+
+    for event in events:
+        relayed_events.labels(event.event_type).inc()
+    return len(events)
+
+
+def run():
+    relayed, window_started = 0, time.monotonic()
+
+    while True:
+        start = time.perf_counter()
+        try:
+            # replaces a connection the database dropped, e.g. after a failover
+            close_old_connections()
+            count = relay_batch()
+        except Exception as e:
+            print('Outbox relay error:', e)
+            relay_failures.inc()
+            time.sleep(poll_interval)
+            continue
+
+        if count:
+            relay_batch_seconds.observe(time.perf_counter() - start)
+            relayed += count
+
+        if time.monotonic() - window_started >= 60:
+            relay_backlog.set(OutboxEvent.objects.count())
+            print(f'Relayed {relayed} events in the last minute')
+            relayed, window_started = 0, time.monotonic()
+
+        if count < batch_size:
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    start_http_server(metrics_port)
+    print('Started Relaying')
+    run()
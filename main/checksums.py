@@ -0,0 +1,27 @@
+"""
+Range checksums for comparing the admin and products services' product
+tables. Ids are split into fixed buckets of bucket_size, so a missing or
+extra row only changes the checksum of its own bucket. Likes are left out,
+each service counts its own.
+"""
+import hashlib
+
+
+def checksum_buckets(rows, bucket_size):
+    """
+    Folds (id, title, image) rows, ordered by id, into {bucket: [count,
+    checksum]}. Bucket n holds ids n * bucket_size to (n + 1) * bucket_size - 1.
+    """
+    buckets = {}
+    bucket, digest, count = None, None, 0
+    for id, title, image in rows:
+        if id // bucket_size != bucket:
+            if bucket is not None:
+                buckets[bucket] = [count, digest.hexdigest()]
+            bucket, digest, count = id // bucket_size, hashlib.blake2b(digest_size=16), 0
+        digest.update(f'{id}\x1f{title}\x1f{image}\x1e'.encode())
+        count += 1
+
+    if bucket is not None:
+        buckets[bucket] = [count, digest.hexdigest()]
+    return buckets
@@ -1,73 +1,212 @@
-import pika, json
-from main import app, Product, db  
+import pika, time
+from collections import Counter
+import os
+
+# consumer pool settings, must be set before main creates the engine
+os.environ.setdefault("DB_POOL_PROFILE", "consumer")
+
+from sqlalchemy import select
+
+from main import app, Product, ProductTombstone, db, upsert, bump_catalogue_version
 from opentelemetry import trace
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import SimpleSpanProcessor, BatchSpanProcessor
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-import os
-# Match the same service name
-resource = Resource(attributes={
-    SERVICE_NAME: "flask_service"  # Same as main.py
-})
+from telemetry import setup_tracing
+from events import PUBLISHED_AT, decode
+from topology import (dead_letter_queue, declare_topology, event_stream, retry_delays, retry_queue, shard_queue,
+                      stream_priority)
+from runner import (Lane, WorkerStats, consume_lanes, consumer_shards, record_batch, serve_metrics,
+                    stage_seconds, supervise, worker_shards)
 
-trace.set_tracer_provider(TracerProvider(resource=resource))
-tracer_provider = trace.get_tracer_provider()
-jeager_url = os.environ.get("JAEGAR_URL")
-jeager_port = os.environ.get("JAEGAR_PORT")
+# Reuses the provider main.py already installed
+setup_tracing("flask_service")
 
 rabbit_mq_url = os.environ.get("RABBIT_MQ_URL")
 
-
-jaeger_exporter = JaegerExporter(
-    agent_host_name=jeager_url,
-    agent_port=6831,
-)
-tracer_provider.add_span_processor(BatchSpanProcessor(jaeger_exporter))
+# Messages are collected for up to batch_timeout seconds or batch_size messages
+prefetch_count = int(os.environ.get("RABBIT_MQ_PREFETCH", "1000"))
+batch_size = int(os.environ.get("CONSUMER_BATCH_SIZE", str(prefetch_count)))
+batch_timeout = float(os.environ.get("CONSUMER_BATCH_TIMEOUT", "0.5"))
 
 # Now get the tracer
 tracer = trace.get_tracer(__name__)
 
-params = pika.URLParameters(rabbit_mq_url)
-connection = pika.BlockingConnection(params)
-channel = connection.channel()
-
-channel.queue_declare(queue='main')
-
-
-def callback(ch, method, properties, body):
-    print('Received in main')
-    data = json.loads(body)
-    print(data)
-
-    ctx = TraceContextTextMapPropagator().extract(properties.headers or {})
-
-    with tracer.start_as_current_span("process_message", context=ctx):
-        with app.app_context():
-            if properties.content_type == 'product_created':
-                product = Product(id=data['id'], title=data['title'], image=data['image'])
-                db.session.add(product)
-                db.session.commit()
-                print('Product Created')
-
-            elif properties.content_type == 'product_updated':
-                product = Product.query.get(data['id'])
-                product.title = data['title']
-                product.image = data['image']
-                db.session.commit()
-                print('Product Updated')
-
-            elif properties.content_type == 'product_deleted':
-                product = Product.query.get(data)
-                db.session.delete(product)
-                db.session.commit()
-                print('Product Deleted')
-
-
-channel.basic_consume(queue='main', on_message_callback=callback, auto_ack=True)
-
-print('Started Consuming')
 
-channel.start_consuming()
-channel.close()
+def event_version(data):
+    """
+    The admin relay numbers product events with their outbox id, which grows
+    in the order a product's changes commit. A message that comes back from
+    a retry queue behind newer ones is older than what was applied since and
+    loses to it. Events from producers that do not number them are 0.
+    """
+    return int(data.get('version', 0))
+
+
+def save_product(data):
+    return {
+        'id': int(data['id']), 'title': data['title'], 'image': data['image'], 'likes': data.get('likes', 0),
+        'version': event_version(data),
+    }
+
+
+def delete_product(data):
+    return {'id': int(data['id']), 'version': event_version(data), 'deleted': True}
+
+
+handlers = {
+    'product_created': save_product,
+    'product_updated': save_product,
+    'product_deleted': delete_product,
+}
+
+# the streams this service consumes, one queue each per worker
+streams = sorted({event_stream(event_type) for event_type in handlers})
+
+
+def coalesce(events):
+    """
+    Folds (event_type, data) events into the latest write per product id:
+    {id: row} for creates/updates and {id: {'id', 'version', 'deleted'}} for
+    deletes. The highest version wins, and the later event on a tie.
+    """
+    changes = {}
+    for event_type, data in events:
+        handler = handlers.get(event_type)
+        if handler is None:
+            print('Ignoring unknown event:', event_type)
+            continue
+        change = handler(data)
+        current = changes.get(change['id'])
+        if current is None or change['version'] >= current['version']:
+            changes[change['id']] = change
+    return changes
+
+
+def stale_changes(changes):
+    """
+    Ids whose change is older than the version already applied, or than the
+    delete that removed the product. The rows are locked until the batch
+    commits; a shard has a single consumer, so nothing else applies events
+    for them meanwhile.
+    """
+    ids = list(changes)
+    applied = dict(db.session.execute(
+        select(Product.id, Product.version).where(Product.id.in_(ids)).with_for_update()
+    ).all())
+    deleted = dict(db.session.execute(
+        select(ProductTombstone.id, ProductTombstone.version).where(ProductTombstone.id.in_(ids))
+    ).all())
+    return {
+        id for id, change in changes.items()
+        if change['version'] < applied.get(id, 0) or (id in deleted and change['version'] <= deleted[id])
+    }
+
+
+def apply_changes(changes):
+    with app.app_context():
+        stale = stale_changes(changes) if changes else set()
+        fresh = [change for id, change in changes.items() if id not in stale]
+        rows = [change for change in fresh if not change.get('deleted')]
+        deleted = [change for change in fresh if change.get('deleted')]
+
+        if rows:
+            # likes are only taken on insert, after that this service counts its own
+            db.session.execute(upsert(Product.__table__, rows, lambda new: {
+                'title': new.title,
+                'image': new.image,
+                'version': new.version,
+            }))
+        if deleted:
+            Product.query.filter(Product.id.in_([change['id'] for change in deleted])).delete(synchronize_session=False)
+            db.session.execute(upsert(ProductTombstone.__table__, [
+                {'id': change['id'], 'version': change['version']} for change in deleted
+            ], lambda new: {'version': new.version}))
+        if rows or deleted:
+            db.session.execute(bump_catalogue_version())
+        db.session.commit()
+
+    if stale:
+        print(f'Skipped {len(stale)} product events older than the ones already applied')
+    return len(rows), len(deleted)
+
+
+def flush(channel, batch, queue, lag=0):
+    """
+    Writes the batch as one INSERT ... ON DUPLICATE KEY UPDATE and one
+    DELETE ... WHERE id IN (...), then acks everything in one multi-ack.
+    lag is the longest a message in the batch waited on the queue.
+    """
+    if not batch:
+        return
+
+    last_tag = batch[-1][0]
+    links = [
+        trace.Link(trace.get_current_span(ctx).get_span_context())
+        for _, ctx, _ in batch
+    ]
+
+    with tracer.start_as_current_span("process_products_batch", links=links) as span:
+        span.set_attribute("batch.messages", len(batch))
+        events = [event for _, _, message_events in batch for event in message_events]
+        try:
+            with stage_seconds.labels(queue, 'apply').time():
+                upserted, deleted = apply_changes(coalesce(events))
+        except Exception:
+            # runner.flush_lane retries the messages one by one
+            with app.app_context():
+                db.session.rollback()
+            raise
+        with stage_seconds.labels(queue, 'ack').time():
+            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        record_batch(queue, len(batch), Counter(event_type for event_type, _ in events), lag)
+        span.set_attribute("batch.upserted", upserted)
+        span.set_attribute("batch.deleted", deleted)
+        print(f'Synced {len(batch)} messages: {upserted} upserted, {deleted} deleted')
+
+    batch.clear()
+
+
+def read(properties, body):
+    # decode() raises ValueError for a message it cannot read, which the runner dead letters
+    headers = properties.headers or {}
+    events = decode(properties.content_type, body)
+    return TraceContextTextMapPropagator().extract(headers), events, headers.get(PUBLISHED_AT)
+
+
+def consume(connection, lanes, stopping=None, stats=None):
+    consume_lanes(connection, lanes, read, flush, batch_size, batch_timeout, stopping, stats)
+
+
+def work(index, stopping):
+    """One runner worker: its own connection, and a channel and prefetch per shard queue it consumes."""
+    with app.app_context():
+        # never reuse pooled connections inherited from the supervisor
+        db.engine.dispose(close=False)
+
+    connection = pika.BlockingConnection(pika.URLParameters(rabbit_mq_url))
+    declare_topology(connection.channel(), 'main', streams, consumer_shards)
+
+    lanes = []
+    for stream in streams:
+        for shard in worker_shards(index):
+            channel = connection.channel()
+            channel.basic_qos(prefetch_count=prefetch_count)
+            # a failed message is only acked once the broker has its retry or dead letter copy
+            channel.confirm_delivery()
+            queue = shard_queue('main', stream, shard)
+            lanes.append(Lane(
+                stream, queue, channel, stream_priority(stream),
+                retry_queues=[retry_queue(queue, delay) for delay in retry_delays],
+                dead_letter_queue=dead_letter_queue('main', stream)
+            ))
+
+    serve_metrics(index)
+    print(f"Worker {index} consuming {', '.join(lane.queue for lane in lanes)}")
+
+    try:
+        consume(connection, lanes, stopping, WorkerStats(index, lanes))
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    supervise(work)
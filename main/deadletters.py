@@ -0,0 +1,59 @@
+"""
+Inspects, replays and purges the dead letter queues consumer.py moves
+messages to once they have failed every retry or could not be read:
+
+    python deadletters.py list products [--limit 20] [--events]
+    python deadletters.py replay products [--limit 1000]
+    python deadletters.py purge products
+
+list leaves the messages where they are. replay publishes them back to the
+events exchange with their original routing key and a fresh set of retries,
+so fix whatever made them fail first.
+"""
+import argparse
+import json
+import os
+
+import pika
+
+from events import decode
+from runner import dead_letters, describe_dead_letter, replay_dead_letters
+from topology import dead_letter_queue, events_exchange
+
+rabbit_mq_url = os.environ.get("RABBIT_MQ_URL")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['list', 'replay', 'purge'])
+    parser.add_argument('stream', help='Stream whose dead letters to act on, e.g. products')
+    parser.add_argument('--limit', type=int, default=None, help='At most this many messages, 20 for list')
+    parser.add_argument('--events', action='store_true', help='Also decode and print the events of listed messages')
+    options = parser.parse_args()
+
+    queue = dead_letter_queue('main', options.stream)
+    connection = pika.BlockingConnection(pika.URLParameters(rabbit_mq_url))
+    channel = connection.channel()
+    try:
+        if options.command == 'list':
+            for properties, body in dead_letters(channel, queue, options.limit or 20):
+                message = describe_dead_letter(properties, body)
+                if options.events:
+                    try:
+                        message['events'] = decode(properties.content_type, body)
+                    except ValueError as e:
+                        message['events'] = f'unreadable: {e}'
+                print(json.dumps(message, default=str))
+        elif options.command == 'replay':
+            channel.confirm_delivery()
+            replayed, skipped = replay_dead_letters(channel, queue, events_exchange('main'), options.limit)
+            print(f'Replayed {replayed} messages from {queue}, skipped {skipped} without a routing key')
+        else:
+            purged = channel.queue_purge(queue=queue).method.message_count
+            print(f'Purged {purged} messages from {queue}')
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+The envelope for messages between the admin and products services. A body
+carries a version and one or more events, so a batch of events travels in
+a single frame:
+
+    {"v": 1, "events": [["product_created", {"id": 1, ...}], ["product_deleted", {"id": 2}]]}
+
+The content_type property names the encoding, JSON by default or msgpack
+with EVENT_ENCODING=msgpack, and the type property names the event, or
+"batch" when there is more than one. Consumers accept every encoding, so
+producers can be switched one at a time.
+"""
+import json
+import os
+import time
+
+EVENT_VERSION = 1
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+BATCH = 'batch'
+# header with the publish time in epoch milliseconds, consumers measure queue dwell from it
+PUBLISHED_AT = 'x-published-at'
+
+event_encoding = os.environ.get("EVENT_ENCODING", "json")
+
+
+class UnsupportedEvent(ValueError):
+    pass
+
+
+def publish_time():
+    # an int, as pika cannot encode floats in header tables
+    return int(time.time() * 1000)
+
+
+def upgrade(event_type, data):
+    """
+    Brings an event from before the envelope up to the current version:
+    deletes and likes used to send a bare product id.
+    """
+    if not isinstance(data, dict):
+        data = {'id': data}
+    return event_type, data
+
+
+def encode(events, encoding=None):
+    """Returns (content_type, type, body) for a list of (event_type, data) pairs."""
+    envelope = {'v': EVENT_VERSION, 'events': [[event_type, data] for event_type, data in events]}
+    event_type = events[0][0] if len(events) == 1 else BATCH
+
+    if (encoding or event_encoding) == 'msgpack':
+        import msgpack
+        return MSGPACK, event_type, msgpack.packb(envelope)
+    return JSON, event_type, json.dumps(envelope, separators=(',', ':'))
+
+
+def decode(content_type, body):
+    """
+    Returns the (event_type, data) pairs carried by a message. Raises
+    ValueError, or UnsupportedEvent when the body decodes but is not an
+    envelope of a version this consumer knows.
+    """
+    if content_type == MSGPACK:
+        import msgpack
+        envelope = msgpack.unpackb(body, strict_map_key=False)
+    elif content_type == JSON:
+        envelope = json.loads(body)
+    else:
+        # a producer from before the envelope: the event type is in content_type
+        return [upgrade(content_type, json.loads(body))]
+
+    if not isinstance(envelope, dict):
+        raise UnsupportedEvent(f'Expected an envelope object, got {type(envelope).__name__}')
+    if envelope.get('v') != EVENT_VERSION:
+        raise UnsupportedEvent(f'Unsupported event version {envelope.get("v")!r}')
+    events = envelope.get('events')
+    if not isinstance(events, list) or not all(isinstance(event, list) and len(event) == 2 for event in events):
+        raise UnsupportedEvent('Expected events as a list of [event_type, data] pairs')
+    return [(event_type, data) for event_type, data in events]
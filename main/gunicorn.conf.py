@@ -0,0 +1,7 @@
+# Read by gunicorn from the working directory, see start.sh
+
+
+def post_worker_init(worker):
+    # relays like outbox rows a dead worker left behind without waiting for the next like
+    from main import like_aggregator
+    like_aggregator.start()
@@ -0,0 +1,72 @@
+import atexit
+import os
+import threading
+import time
+from collections import Counter
+
+from prometheus_client import Histogram
+
+like_flush_interval = float(os.environ.get("LIKE_FLUSH_INTERVAL", "1"))
+
+# user_lookup and insert run in the request, flush_update and flush_publish in the flush thread
+like_stage_seconds = Histogram('like_stage_seconds', 'Time spent in each stage of a like', ['stage'])
+
+
+class LikeAggregator:
+    """
+    Counts likes per product in memory and hands the deltas to write every
+    interval seconds, so a burst of likes costs one UPDATE per product and
+    one message instead of one of each per like. Deltas that fail to write
+    are kept for the next flush. relay(), when given, runs after a flush that
+    wrote likes or whose previous relay() returned True for work left over.
+    """
+
+    def __init__(self, interval, write, relay=None):
+        self.interval = interval
+        self.write = write
+        self.relay = relay
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._pid = None
+        # a new worker relays whatever an earlier one left behind
+        self._unrelayed = True
+
+    def add(self, product_id, count=1):
+        self.start()
+        with self._lock:
+            self._pending[product_id] += count
+
+    def flush(self):
+        with self._lock:
+            likes, self._pending = self._pending, Counter()
+        if likes:
+            try:
+                self.write(likes)
+            except Exception as e:
+                print('Failed to write likes, keeping them for the next flush:', e)
+                with self._lock:
+                    self._pending.update(likes)
+
+        if self.relay is not None and (likes or self._unrelayed):
+            self._unrelayed = self.relay()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        """
+        Starts the flush thread in this process and flushes what is left when
+        it exits. Threads do not survive a gunicorn fork, so every web worker
+        calls it once it has loaded the app (gunicorn.conf.py), and add() as
+        a fallback. Other processes that import main never flush.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending = Counter()
+                threading.Thread(target=self._run, name='like-flush', daemon=True).start()
+                atexit.register(self.flush)
@@ -1,80 +1,89 @@
+import time
+startup_started = time.perf_counter()
+
 import os
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import requests
-from flask import Flask, jsonify, abort
+from flask import Flask, jsonify, abort, request, url_for, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, delete, exists, insert, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_migrate import Migrate
 from prometheus_flask_exporter import PrometheusMetrics
-from producer import publish
-import boto3
+from producer import confirmed_publisher, send_events
+from likes import LikeAggregator, like_flush_interval, like_stage_seconds
+from users import random_user_id, CircuitOpenError
+from prometheus_client import Counter, Gauge
+import secret_store
+from pooling import db_pool_profile, engine_options
+from replica import REPLICA, ReplicaReads, replica_uri
 import json
-from botocore.exceptions import ClientError
 
 # OpenTelemetry imports
 from opentelemetry import trace
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import SimpleSpanProcessor, BatchSpanProcessor
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+from telemetry import setup_tracing
 
 # Set up tracing
-resource = Resource(attributes={SERVICE_NAME: "flask_service"})
-provider = TracerProvider(resource=resource)
-trace.set_tracer_provider(provider)
-jeager_url = os.environ.get("JAEGAR_URL")
-jeager_port = os.environ.get("JAEGAR_PORT")
+provider = setup_tracing("flask_service")
 rabbit_mq_url = os.environ.get("RABBIT_MQ_URL")
 
-jaeger_exporter = JaegerExporter(
-    agent_host_name=jeager_url,
-    agent_port=6831,
-)
-provider.add_span_processor(BatchSpanProcessor(jaeger_exporter))
-
 tracer = trace.get_tracer(__name__)
 
 # --- Flask App Setup ---
 app = Flask(__name__)
-FlaskInstrumentor().instrument_app(app, tracer_provider=provider)
-RequestsInstrumentor().instrument()
+if provider is not None:
+    from opentelemetry.instrumentation.flask import FlaskInstrumentor
+    from opentelemetry.instrumentation.requests import RequestsInstrumentor
+
+    FlaskInstrumentor().instrument_app(app, tracer_provider=provider)
+    RequestsInstrumentor().instrument()
 
 current_region = os.environ.get("AWS_REGION")
 secret_name = os.environ.get("SECRET_NAME")
 
-if not current_region or not secret_name:
-    raise RuntimeError("Missing required environment variables: AWS_REGION or DB_SECRET_NAME")
-
 
 def get_database_secrets():
-   
-    try:
-        print(f"Fetching secret: {secret_name}")
-        client = boto3.client("secretsmanager", region_name=current_region)
-        response = client.get_secret_value(SecretId=secret_name)
-        return json.loads(response["SecretString"])
-    except ClientError as e:
-        print(f"Failed to fetch secret: {e}")
-        raise RuntimeError("Could not retrieve DB credentials")
-secrets = get_database_secrets()
-
-db_user = secrets.get("username", os.environ.get("SQL_USER", "user"))
-db_password = secrets.get("password", os.environ.get("SQL_PASSWORD", "password"))
-db_host = secrets.get("host", os.environ.get("SQL_HOST", "localhost"))
-db_port = secrets.get("port", os.environ.get("SQL_PORT", "3306"))
-db_name = secrets.get("dbname", os.environ.get("SQL_DATABASE", "main"))
-
-
-app.config["SQLALCHEMY_DATABASE_URI"] = f"mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+    return secret_store.get_secret(secret_name, current_region)
+
+
+def get_database_uri():
+    # a complete URI, e.g. the SQLite database used by benchmark.py, skips Secrets Manager
+    if os.environ.get("SQLALCHEMY_DATABASE_URI"):
+        return os.environ["SQLALCHEMY_DATABASE_URI"]
+
+    if not secret_store.secrets_file and (not current_region or not secret_name):
+        raise RuntimeError("Missing required environment variables: AWS_REGION or DB_SECRET_NAME")
+
+    secrets = get_database_secrets()
+
+    db_user = secrets.get("username", os.environ.get("SQL_USER", "user"))
+    db_password = secrets.get("password", os.environ.get("SQL_PASSWORD", "password"))
+    db_host = secrets.get("host", os.environ.get("SQL_HOST", "localhost"))
+    db_port = secrets.get("port", os.environ.get("SQL_PORT", "3306"))
+    db_name = secrets.get("dbname", os.environ.get("SQL_DATABASE", "main"))
+
+    return f"mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+
+
+app.config["SQLALCHEMY_DATABASE_URI"] = get_database_uri()
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+# web workers read from a replica when one is configured, see replica.py; consumer.py writes what it reads
+replica_database_uri = replica_uri(app.config["SQLALCHEMY_DATABASE_URI"])
+if replica_database_uri and db_pool_profile == 'web':
+    app.config["SQLALCHEMY_BINDS"] = {REPLICA: {"url": replica_database_uri, **engine_options(replica_database_uri)}}
 CORS(app)
 metrics = PrometheusMetrics(app)
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
+replica_reads = ReplicaReads(db)
+replica_reads.init_app(app)
 
 @dataclass
 class Product(db.Model):
@@ -82,12 +91,22 @@ class Product(db.Model):
     id: int 
     title: str 
     image: str 
+    likes: int
 
     # for db
     id = db.Column(db.Integer, primary_key=True, autoincrement=False) # product_id created in django
     title = db.Column(db.String(200))
     image = db.Column(db.String(200))
-    # no likes -> in django
+    # counted here from ProductUser inserts, django gets the same deltas in batches
+    likes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # version of the last product event applied, see consumer.py
+    version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+
+class ProductTombstone(db.Model):
+    # version of the event that deleted a product, so a retried older create cannot bring it back
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.BigInteger, nullable=False)
 
 @dataclass
 class ProductUser(db.Model):
@@ -95,37 +114,315 @@ class ProductUser(db.Model):
     user_id = db.Column(db.Integer)
     product_id = db.Column(db.Integer)
 
-    # not sure if working ?
-    UniqueConstraint('user_id', 'product_id', name='user_product_unique')
+    # also serves "has this user liked this product" lookups
+    __table_args__ = (
+        UniqueConstraint('user_id', 'product_id', name='user_product_unique'),
+    )
+
+
+def insert_like(user_id, product_id):
+    return insert(ProductUser.__table__).values(user_id=user_id, product_id=product_id) \
+        .prefix_with('IGNORE', dialect='mysql') \
+        .prefix_with('OR IGNORE', dialect='sqlite')
+
+
+def add_like(user_id, product_id):
+    """
+    Inserts the like unless it already exists. Returns False for a duplicate,
+    detected by the unique index in the same round trip.
+    """
+    result = db.session.execute(insert_like(user_id, product_id))
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def has_liked(user_id, product_id, bind_arguments=None):
+    stmt = select(exists().where(ProductUser.user_id == user_id, ProductUser.product_id == product_id))
+    return db.session.execute(stmt, bind_arguments=bind_arguments).scalar()
+
+
+@app.cli.command('dedupe-likes')
+def dedupe_likes():
+    """Removes duplicate likes so the user_product_unique index can be created."""
+    result = db.session.execute(text(
+        'DELETE newer FROM product_user newer '
+        'JOIN product_user older ON newer.user_id = older.user_id '
+        'AND newer.product_id = older.product_id AND newer.id > older.id'
+    ))
+    db.session.commit()
+    print(f'Removed {result.rowcount} duplicate likes')
+
+class CatalogueVersion(db.Model):
+    # single row bumped by consumer.py every time it syncs a batch of products
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+def catalogue_version(bind_arguments=None):
+    stmt = select(CatalogueVersion.version).where(CatalogueVersion.id == 1)
+    return db.session.execute(stmt, bind_arguments=bind_arguments).scalar() or 0
+
+
+def upsert(table, rows, updates):
+    """
+    INSERT ... ON DUPLICATE KEY UPDATE on MySQL, or ON CONFLICT DO UPDATE on
+    the SQLite database used by benchmark.py. updates maps the proposed row
+    to the {column: value} to set when the primary key already exists.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        stmt = sqlite_insert(table).values(rows)
+        return stmt.on_conflict_do_update(index_elements=list(table.primary_key), set_=updates(stmt.excluded))
+    stmt = mysql_insert(table).values(rows)
+    return stmt.on_duplicate_key_update(updates(stmt.inserted))
+
+
+def bump_catalogue_version():
+    # invalidates the cached /flask/api/products pages in every web worker
+    return upsert(CatalogueVersion.__table__, [{'id': 1, 'version': 1}], lambda new: {
+        'version': CatalogueVersion.version + 1
+    })
+
+
+class LikeOutbox(db.Model):
+    # product_likes deltas for django, written with the UPDATEs they match and deleted once relayed
+    id = db.Column(db.Integer, primary_key=True)
+    likes = db.Column(db.JSON, nullable=False)
+    headers = db.Column(db.JSON, nullable=False, default=dict)
+
+
+like_relay_batch_size = int(os.environ.get("LIKE_RELAY_BATCH_SIZE", "100"))
+like_relay_failures = Counter('like_relay_failures_total', 'Like outbox relays that failed and will be retried')
+
+
+def write_likes(likes):
+    """
+    Applies a {product_id: count} batch from the like aggregator as one
+    UPDATE ... SET likes = likes + n per product, and records the same
+    deltas for django in the like outbox in the same transaction. Like
+    counts do not bump the catalogue version, see ProductsCache.
+    """
+    with tracer.start_as_current_span("flush_likes") as span:
+        span.set_attribute("likes.products", len(likes))
+        span.set_attribute("likes.total", sum(likes.values()))
+        headers = {}
+        TraceContextTextMapPropagator().inject(headers)
+        with app.app_context(), like_stage_seconds.labels('flush_update').time():
+            try:
+                for product_id, count in likes.items():
+                    Product.query.filter_by(id=product_id).update(
+                        {Product.likes: Product.likes + count}, synchronize_session=False
+                    )
+                db.session.add(LikeOutbox(
+                    likes={str(product_id): count for product_id, count in likes.items()}, headers=headers
+                ))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+
+def relay_likes():
+    """
+    Sends the oldest like outbox rows to django as product_likes messages
+    with publisher confirms, and deletes the ones the broker took. Returns
+    True when rows are left, because a publish failed or there were more
+    than a batch, so the aggregator calls it again after its next flush.
+    A crash between a confirm and the delete sends those deltas twice.
+    """
+    with app.app_context(), like_stage_seconds.labels('flush_publish').time():
+        try:
+            # other workers skip the rows this one is sending; increments commute, so order does not matter
+            stmt = select(LikeOutbox).order_by(LikeOutbox.id).limit(like_relay_batch_size) \
+                .with_for_update(skip_locked=True)
+            rows = db.session.scalars(stmt).all()
+            relayed = []
+            try:
+                for row in rows:
+                    # any shard may apply them; spread workers by pid
+                    send_events([('product_likes', row.likes)], str(os.getpid()), row.headers, confirmed_publisher)
+                    relayed.append(row.id)
+            finally:
+                if relayed:
+                    db.session.execute(delete(LikeOutbox).where(LikeOutbox.id.in_(relayed)))
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print('Failed to relay likes, retrying after the next flush:', e)
+            like_relay_failures.inc()
+            return True
+        return len(rows) == like_relay_batch_size
+
+
+like_aggregator = LikeAggregator(like_flush_interval, write_likes, relay_likes)
+
+
+products_page_size = int(os.environ.get("PRODUCTS_PAGE_SIZE", "100"))
+products_max_page_size = int(os.environ.get("PRODUCTS_MAX_PAGE_SIZE", "1000"))
+products_version_ttl = float(os.environ.get("PRODUCTS_VERSION_TTL", "1"))
+# like counts in cached pages and ETags are at most this old
+products_likes_max_age = float(os.environ.get("PRODUCTS_LIKES_MAX_AGE", "10"))
+products_stream_chunk_size = int(os.environ.get("PRODUCTS_STREAM_CHUNK_SIZE", "2000"))
+
+
+class ProductsCache:
+    """
+    Rendered /flask/api/products pages for the current catalogue version.
+    The version is re-read from the primary at most once per ttl seconds, so
+    repeated and conditional requests are served without touching the db.
+    Like flushes leave the version alone, so pages also expire with each
+    likes_max_age window of the wall clock, which every worker shares.
+    """
+
+    def __init__(self, ttl, likes_max_age, max_pages=256):
+        self.ttl = ttl
+        self.likes_max_age = likes_max_age
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._version = None
+        self._checked_at = 0.0
+        self._window = None
+
+    def version(self):
+        if self._version is None or time.monotonic() - self._checked_at >= self.ttl:
+            version = catalogue_version()
+            with self._lock:
+                if version != self._version:
+                    self._pages.clear()
+                self._version = version
+                self._checked_at = time.monotonic()
+        return self._version
+
+    def likes_window(self):
+        window = int(time.time() // self.likes_max_age)
+        with self._lock:
+            if window != self._window:
+                self._pages.clear()
+                self._window = window
+        return window
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        with self._lock:
+            self._pages[key] = page
+            if len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+
+products_cache = ProductsCache(products_version_ttl, products_likes_max_age)
+
+
+def stream_products(cursor, chunk_size):
+    """
+    Yields every product after cursor as a JSON array, a chunk of rows at a
+    time. Rows come straight off a server-side cursor as tuples, so neither
+    the whole list nor a Product object per row is ever built.
+    """
+    columns = [Product.id, Product.title, Product.image, Product.likes]
+    stmt = select(*columns).where(Product.id > cursor).order_by(Product.id) \
+        .execution_options(stream_results=True, yield_per=chunk_size)
+    result = db.session.execute(stmt, bind_arguments=replica_reads.bind_arguments())
+
+    yield '['
+    separator = ''
+    for rows in result.partitions(chunk_size):
+        yield separator + ','.join(json.dumps(row._asdict(), separators=(',', ':')) for row in rows)
+        separator = ','
+    yield ']'
+
 
 @app.route('/flask/api/products')
 def index():
-    with tracer.start_as_current_span("get_all_products"):
-        return jsonify(db.session.query(Product).all())
+    with tracer.start_as_current_span("get_all_products") as span:
+        cursor = request.args.get('cursor', 0, type=int)
+        limit = min(max(request.args.get('limit', products_page_size, type=int), 1), products_max_page_size)
+
+        # ?stream=1 sends the whole catalogue after cursor in one streamed response, and so does
+        # a request without cursor or limit, which got the full list before pages existed
+        paginated = 'cursor' in request.args or 'limit' in request.args
+        stream = request.args.get('stream', '').lower() in ('1', 'true') or not paginated
+
+        version = products_cache.version()
+        window = products_cache.likes_window()
+        etag = f'{version}.{window}-{cursor}-{"all" if stream else limit}'
+        span.set_attribute("products.version", version)
+
+        if request.if_none_match.contains(etag):
+            return app.response_class(status=304, headers={'ETag': f'"{etag}"'})
+
+        if stream:
+            span.set_attribute("products.stream", True)
+            response = app.response_class(
+                stream_with_context(stream_products(cursor, products_stream_chunk_size)),
+                mimetype='application/json'
+            )
+            response.set_etag(etag)
+            return response
+
+        page = products_cache.get((version, window, cursor, limit))
+        span.set_attribute("products.cache_hit", page is not None)
+        if page is None:
+            bind_arguments = replica_reads.bind_arguments()
+            # a replica that is behind would cache old rows under the new version
+            if bind_arguments and catalogue_version(bind_arguments) < version:
+                bind_arguments = {}
+            # keyset pagination: ids are assigned by django, so they are stable and indexed
+            stmt = select(Product).where(Product.id > cursor).order_by(Product.id).limit(limit)
+            products = db.session.scalars(stmt, bind_arguments=bind_arguments).all()
+            next_cursor = products[-1].id if len(products) == limit else None
+            page = (jsonify(products).get_data(), next_cursor)
+            products_cache.set((version, window, cursor, limit), page)
+
+        body, next_cursor = page
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+            response.headers['Link'] = f'<{url_for("index", cursor=next_cursor, limit=limit)}>; rel="next"'
+        return response
 
 @app.route('/flask/api/products/<int:id>/like', methods=['POST'])
 def like(id):
     with tracer.start_as_current_span("like_product"):
-        req = requests.get('https://django.seyram.site/api/user')
-        json_data = req.json()
+        try:
+            with like_stage_seconds.labels('user_lookup').time():
+                user_id = random_user_id()
+        except (CircuitOpenError, requests.RequestException) as e:
+            print('User lookup failed:', e)
+            abort(503, 'User service unavailable.')
 
-    try:
-        product_user = ProductUser(user_id=json_data['id'], product_id=id)
-        db.session.add(product_user)
-        db.session.commit()
+        with like_stage_seconds.labels('insert').time():
+            added = add_like(user_id, id)
+        if not added:
+            abort(400, 'You already liked this product.')
 
-        publish('product_liked', id)
-    except Exception as e:
-        print(e)
-        abort(400, 'You already liked this product.')
+        # counted in memory, written to MySQL and the like outbox by the next flush
+        like_aggregator.add(id)
 
     return jsonify({
         'message': 'success'
     })
 
+@app.route('/flask/api/products/<int:id>/likes/<int:user_id>')
+def liked(id, user_id):
+    with tracer.start_as_current_span("has_liked_product"):
+        return jsonify({'liked': has_liked(user_id, id, replica_reads.bind_arguments())})
+
 @app.route('/ready')
 def readiness_check():
     return jsonify({'status': 'ok'}), 200
 
+startup_seconds = Gauge('app_startup_seconds', 'Time spent importing and configuring the app', ['phase'])
+startup_seconds.labels('total').set(time.perf_counter() - startup_started)
+startup_seconds.labels('secrets').set(secret_store.fetch_seconds)
+print(f'App ready in {time.perf_counter() - startup_started:.3f}s '
+      f'({secret_store.fetch_seconds:.3f}s fetching secrets)')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port='5000')
\ No newline at end of file
@@ -0,0 +1,68 @@
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# web for the HTTP workers, consumer for consumer.py, which sets it before importing main
+db_pool_profile = os.environ.get("DB_POOL_PROFILE", "web")
+
+DB_POOL_PROFILES = {
+    # many short checkouts from gunicorn threads, overflow absorbs bursts
+    'web': {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 10, 'pool_recycle': 1800},
+    # one batch at a time per worker process, a spare for the version bump
+    'consumer': {'pool_size': 2, 'max_overflow': 0, 'pool_timeout': 30, 'pool_recycle': 3600},
+}
+
+pool_wait = Histogram(
+    'db_pool_wait_seconds',
+    'Time taken to get a connection from the pool, including opening a new one',
+    ['profile']
+)
+pool_checkouts = Counter('db_pool_checkouts_total', 'Connections handed out by the pool', ['profile'])
+pool_timeouts = Counter('db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection', ['profile'])
+pool_checked_out = Gauge('db_pool_checked_out', 'Connections currently in use', ['profile'])
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that reports wait time, checkouts and connections in use."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_timeouts.labels(db_pool_profile).inc()
+            raise
+        finally:
+            pool_wait.labels(db_pool_profile).observe(time.perf_counter() - start)
+        pool_checkouts.labels(db_pool_profile).inc()
+        pool_checked_out.labels(db_pool_profile).set(self.checkedout())
+        return connection
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        pool_checked_out.labels(db_pool_profile).set(self.checkedout())
+
+
+def engine_options(uri, profile=db_pool_profile):
+    """
+    create_engine() options for the given profile. DB_POOL_SIZE,
+    DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and DB_POOL_RECYCLE override it.
+    Connections are pinged on checkout, so ones the server or a proxy has
+    dropped are replaced instead of failing the first query.
+    """
+    options = {'pool_pre_ping': True}
+    settings = DB_POOL_PROFILES[profile]
+    options['pool_recycle'] = int(os.environ.get("DB_POOL_RECYCLE", settings['pool_recycle']))
+
+    # SQLite (benchmark.py) keeps SQLAlchemy's own pool choice
+    if not uri.startswith('sqlite'):
+        options.update(
+            poolclass=MeteredQueuePool,
+            pool_size=int(os.environ.get("DB_POOL_SIZE", settings['pool_size'])),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", settings['max_overflow'])),
+            pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", settings['pool_timeout'])),
+        )
+    return options
@@ -0,0 +1,124 @@
+"""
+Re-syncs this service's product table with the admin service's. Both sides
+checksum their rows in fixed id buckets, and only the buckets that differ
+are downloaded from /api/products/export and written back with batched
+upserts and deletes. Each range commits on its own, so neither database
+holds long locks. Events applied by consumer.py while a pass runs can make
+a bucket look different, so passes repeat until nothing differs:
+
+    python reconcile.py [--bucket-size 1000] [--passes 3] [--dry-run]
+"""
+import argparse
+import os
+import time
+
+import requests
+from sqlalchemy import select
+
+from main import app, db, Product, upsert, bump_catalogue_version
+from checksums import checksum_buckets
+
+admin_api_url = os.environ.get("ADMIN_API_URL", "https://django.seyram.site/api")
+reconcile_timeout = float(os.environ.get("RECONCILE_TIMEOUT", "300"))
+write_batch_size = int(os.environ.get("RECONCILE_BATCH_SIZE", "1000"))
+# buckets merged into one export request at most
+max_range_buckets = int(os.environ.get("RECONCILE_MAX_RANGE_BUCKETS", "50"))
+
+session = requests.Session()
+
+
+def local_checksums(bucket_size):
+    stmt = select(Product.id, Product.title, Product.image).order_by(Product.id) \
+        .execution_options(stream_results=True, yield_per=10000)
+    return checksum_buckets(db.session.execute(stmt), bucket_size)
+
+
+def remote_checksums(bucket_size):
+    response = session.get(
+        f'{admin_api_url}/products/checksums', params={'bucket_size': bucket_size}, timeout=reconcile_timeout
+    )
+    response.raise_for_status()
+    return {int(bucket): value for bucket, value in response.json()['buckets'].items()}
+
+
+def differing_ranges(local, remote, bucket_size):
+    """Merges adjacent buckets whose checksums differ into (first_id, last_id) ranges."""
+    buckets = sorted(bucket for bucket in local.keys() | remote.keys() if local.get(bucket) != remote.get(bucket))
+
+    runs = []
+    for bucket in buckets:
+        if runs and bucket == runs[-1][1] + 1 and bucket - runs[-1][0] < max_range_buckets:
+            runs[-1][1] = bucket
+        else:
+            runs.append([bucket, bucket])
+    return [(first * bucket_size, (last + 1) * bucket_size - 1) for first, last in runs]
+
+
+def export_range(first, last):
+    response = session.get(
+        f'{admin_api_url}/products/export', params={'after': first - 1, 'until': last}, timeout=reconcile_timeout
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def repair_range(rows, first, last):
+    """
+    Upserts the admin service's rows for first..last and deletes the local
+    rows in that range it no longer has. Returns (upserted, deleted).
+    """
+    remote_ids = {row['id'] for row in rows}
+    local_ids = db.session.execute(select(Product.id).where(Product.id.between(first, last))).scalars()
+    stale = [id for id in local_ids if id not in remote_ids]
+
+    for start in range(0, len(rows), write_batch_size):
+        # likes are only taken on insert, as in consumer.py
+        db.session.execute(upsert(Product.__table__, rows[start:start + write_batch_size], lambda new: {
+            'title': new.title,
+            'image': new.image
+        }))
+    for start in range(0, len(stale), write_batch_size):
+        Product.query.filter(Product.id.in_(stale[start:start + write_batch_size])).delete(synchronize_session=False)
+    db.session.commit()
+
+    return len(rows), len(stale)
+
+
+def reconcile(bucket_size, dry_run=False):
+    """One pass. Returns the number of ranges that differed."""
+    started = time.perf_counter()
+    local, remote = local_checksums(bucket_size), remote_checksums(bucket_size)
+    ranges = differing_ranges(local, remote, bucket_size)
+    print(f'Compared {len(local.keys() | remote.keys())} buckets in {time.perf_counter() - started:.1f}s, '
+          f'{len(ranges)} ranges differ')
+
+    upserted = deleted = 0
+    for first, last in ranges:
+        if dry_run:
+            print(f'  ids {first}-{last} differ')
+            continue
+        written, removed = repair_range(export_range(first, last), first, last)
+        upserted, deleted = upserted + written, deleted + removed
+
+    if upserted or deleted:
+        db.session.execute(bump_catalogue_version())
+        db.session.commit()
+    print(f'Upserted {upserted} and deleted {deleted} products in {time.perf_counter() - started:.1f}s')
+    return len(ranges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bucket-size', type=int, default=1000, help='Ids per checksum bucket')
+    parser.add_argument('--passes', type=int, default=3, help='Stop after this many passes even if ranges still differ')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the ranges that differ')
+    options = parser.parse_args()
+
+    with app.app_context():
+        for _ in range(1 if options.dry_run else options.passes):
+            if not reconcile(options.bucket_size, options.dry_run):
+                break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import time
+
+from flask import g, request
+from prometheus_client import Counter, Gauge
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+REPLICA = 'replica'
+# set on responses to writes, reads stay on the primary while it lasts
+PIN_COOKIE = 'read_primary'
+
+replica_max_lag = float(os.environ.get("REPLICA_MAX_LAG", "5"))
+replica_lag_check_interval = float(os.environ.get("REPLICA_LAG_CHECK_INTERVAL", "5"))
+replica_sticky_seconds = int(os.environ.get("REPLICA_STICKY_SECONDS", "10"))
+
+replica_lag_seconds = Gauge('db_replica_lag_seconds', 'Replica lag at the last check, -1 when it could not be read')
+replica_fallbacks = Counter('db_replica_fallbacks_total', 'Reads sent to the primary instead of the replica', ['reason'])
+
+
+def replica_uri(primary_uri):
+    """
+    SQLALCHEMY_REPLICA_URI, e.g. a second SQLite database standing in for a
+    replica, or the primary's URI with SQL_REPLICA_HOST and SQL_REPLICA_PORT.
+    None when neither is set.
+    """
+    if os.environ.get("SQLALCHEMY_REPLICA_URI"):
+        return os.environ["SQLALCHEMY_REPLICA_URI"]
+    if not os.environ.get("SQL_REPLICA_HOST"):
+        return None
+
+    url = make_url(primary_uri)
+    url = url.set(host=os.environ["SQL_REPLICA_HOST"], port=int(os.environ.get("SQL_REPLICA_PORT", url.port or 3306)))
+    return url.render_as_string(hide_password=False)
+
+
+def measure_lag(connection):
+    """Seconds the replica is behind, or None when replication is broken."""
+    if connection.dialect.name != 'mysql':
+        return 0.0
+    row = connection.execute(text('SHOW REPLICA STATUS')).mappings().first()
+    if row is None:
+        # not replicating, e.g. a second local database standing in for a replica
+        return 0.0
+    if row['Replica_IO_Running'] != 'Yes':
+        # a replica that lost the source shows the lag of what it already received
+        return None
+    lag = row['Seconds_Behind_Source']
+    return None if lag is None else float(lag)
+
+
+class ReplicaReads:
+    """
+    Picks the engine for the web workers' reads. They go to the replica bind
+    except for the rest of a request that is not a GET, HEAD or OPTIONS, for
+    sticky_seconds after a client's write so it reads what it wrote, and
+    while the replica is more than max_lag seconds behind or its lag cannot
+    be read, which is measured at most once per check_interval seconds.
+    """
+
+    def __init__(self, db, max_lag=replica_max_lag, sticky_seconds=replica_sticky_seconds,
+                 check_interval=replica_lag_check_interval):
+        self.db = db
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self.check_interval = check_interval
+        self.enabled = False
+        self.lag = None
+        self._checked_at = None
+
+    def init_app(self, app):
+        self.enabled = REPLICA in app.config.get("SQLALCHEMY_BINDS", {})
+        app.before_request(self._pin)
+        app.after_request(self._set_pin)
+
+    def _pin(self):
+        writes = request.method not in ('GET', 'HEAD', 'OPTIONS')
+        g.read_primary = writes or PIN_COOKIE in request.cookies
+        if self.enabled and g.read_primary and not writes:
+            replica_fallbacks.labels('sticky').inc()
+
+    def _set_pin(self, response):
+        if self.enabled and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            response.set_cookie(PIN_COOKIE, '1', max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+        return response
+
+    def healthy(self):
+        if self._checked_at is None or time.monotonic() - self._checked_at >= self.check_interval:
+            try:
+                with self.db.engines[REPLICA].connect() as connection:
+                    self.lag = measure_lag(connection)
+            except Exception as e:
+                print('Replica lag check failed:', e)
+                self.lag = None
+            self._checked_at = time.monotonic()
+            replica_lag_seconds.set(-1 if self.lag is None else self.lag)
+        return self.lag is not None and self.lag <= self.max_lag
+
+    def engine(self):
+        """The replica engine for a read in this request, or None for the primary."""
+        if not self.enabled or g.get('read_primary', True):
+            return None
+        if not self.healthy():
+            replica_fallbacks.labels('lag').inc()
+            return None
+        return self.db.engines[REPLICA]
+
+    def bind_arguments(self):
+        """For db.session.execute(): {} on the primary."""
+        engine = self.engine()
+        return {} if engine is None else {'bind': engine}
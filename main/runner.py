@@ -0,0 +1,366 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import pika
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Queues every stream is split over. Changing it sends products to other
+# queues, so it has no default and must stay the same across deploys.
+consumer_shards = int(os.environ.get("CONSUMER_SHARDS", "0"))
+# worker n consumes shards n, n + workers, ..., so more workers than shards would idle
+consumer_workers = min(int(os.environ.get("CONSUMER_WORKERS", str(os.cpu_count() or 1))), max(consumer_shards, 1))
+shutdown_timeout = float(os.environ.get("CONSUMER_SHUTDOWN_TIMEOUT", "30"))
+# a worker that keeps dying is restarted after 1, 2, 4, ... seconds, up to the max
+restart_min_delay = float(os.environ.get("CONSUMER_RESTART_DELAY", "1"))
+restart_max_delay = float(os.environ.get("CONSUMER_RESTART_MAX_DELAY", "60"))
+report_interval = float(os.environ.get("CONSUMER_REPORT_INTERVAL", "60"))
+# worker n serves /metrics on this port + n, 0 turns it off
+consumer_metrics_port = int(os.environ.get("CONSUMER_METRICS_PORT", "8002"))
+
+messages_consumed = Counter('consumer_messages_total', 'Messages applied and acked', ['queue'])
+events_consumed = Counter('consumer_events_total', 'Events applied, by type', ['queue', 'event_type'])
+batch_failures = Counter('consumer_batch_failures_total', 'Batches that failed and were retried message by message', ['queue'])
+retried = Counter('consumer_retries_total', 'Messages sent to a retry queue after failing on their own', ['queue'])
+dead_lettered = Counter('consumer_dead_letters_total', 'Messages moved to the dead letter queue', ['queue', 'reason'])
+stage_seconds = Histogram('consumer_stage_seconds', 'Time spent in each stage of a batch', ['queue', 'stage'])
+queue_dwell = Histogram(
+    'consumer_queue_dwell_seconds',
+    'Time from publish to delivery, from the publish timestamp header',
+    ['queue'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+)
+queue_lag = Gauge('consumer_queue_lag_seconds', 'Dwell time of the oldest message in the latest batch', ['queue'])
+queue_depth = Gauge('consumer_queue_depth', 'Messages waiting on the queue at the last report', ['queue', 'stream'])
+
+
+# headers a message picks up when it fails
+ATTEMPTS = 'x-attempts'
+ERROR = 'x-error'
+FAILED_AT = 'x-failed-at'
+ROUTING_KEY = 'x-routing-key'
+
+
+def serve_metrics(index):
+    if consumer_metrics_port:
+        start_http_server(consumer_metrics_port + index)
+
+
+def worker_shards(index, workers=consumer_workers, shards=consumer_shards):
+    return range(index, shards, workers)
+
+
+def observe_delivery(queue, published_at):
+    """
+    Records how long a message waited, given its publish time in epoch
+    milliseconds. Returns the wait, or 0 when unknown.
+    """
+    try:
+        dwell = max(time.time() - int(published_at) / 1000, 0)
+    except (TypeError, ValueError):
+        # missing, or sent by a producer that set it some other way
+        return 0
+    queue_dwell.labels(queue).observe(dwell)
+    return dwell
+
+
+def record_batch(queue, messages, event_types, lag):
+    """Counts an applied batch; event_types maps each event type to how often it occurred."""
+    messages_consumed.labels(queue).inc(messages)
+    for event_type, count in event_types.items():
+        events_consumed.labels(queue, event_type).inc(count)
+    queue_lag.labels(queue).set(lag)
+
+
+class Lane:
+    """
+    One queue a worker consumes, on a channel of its own so that multiple
+    acks never reach another queue's messages, with the batch it is filling.
+    Without retry queues and a dead letter queue, reject() re-raises.
+    """
+
+    def __init__(self, stream, queue, channel, priority=1, retry_queues=(), dead_letter_queue=None):
+        self.stream = stream
+        self.queue = queue
+        self.channel = channel
+        self.priority = priority
+        self.retry_queues = list(retry_queues)
+        self.dead_letter_queue = dead_letter_queue
+        self.batch = []
+        self.started = None
+        self.lag = 0
+        # delivery tag -> (routing key, properties, body) until the message is acked
+        self.messages = {}
+
+    def depth(self):
+        return self.channel.queue_declare(queue=self.queue, durable=True, passive=True).method.message_count
+
+    def reject(self, delivery_tag, error, retry=True):
+        """
+        Moves a message that failed on its own to its next retry queue, or to
+        the dead letter queue once it has used them all or when retry is
+        False, and acks it here.
+        """
+        if self.dead_letter_queue is None:
+            raise error
+
+        routing_key, properties, body = self.messages.pop(delivery_tag)
+        headers = dict(properties.headers or {})
+        attempt = headers.get(ATTEMPTS, 0)
+        headers.setdefault(ROUTING_KEY, routing_key)
+        headers[ERROR] = f'{type(error).__name__}: {error}'[:1000]
+        # epoch milliseconds, pika cannot encode floats in header tables
+        headers[FAILED_AT] = int(time.time() * 1000)
+
+        if retry and attempt < len(self.retry_queues):
+            headers[ATTEMPTS] = attempt + 1
+            target = self.retry_queues[attempt]
+            retried.labels(self.queue).inc()
+        else:
+            target = self.dead_letter_queue
+            dead_lettered.labels(self.queue, 'failed' if retry else 'unreadable').inc()
+        print(f'Moving message to {target}: {headers[ERROR]}')
+
+        properties.headers = headers
+        self.channel.basic_publish(exchange='', routing_key=target, body=body, properties=properties)
+        self.channel.basic_ack(delivery_tag=delivery_tag)
+
+
+class WorkerStats:
+    """Messages handled by one worker, printed every report_interval seconds."""
+
+    def __init__(self, index, lanes):
+        self.index = index
+        self.lanes = lanes
+        self.messages = 0
+        self._window_started = time.monotonic()
+
+    def record(self, messages):
+        self.messages += messages
+        elapsed = time.monotonic() - self._window_started
+        if elapsed >= report_interval:
+            waiting = {}
+            for lane in self.lanes:
+                waiting[lane.queue] = lane.depth()
+                queue_depth.labels(lane.queue, lane.stream).set(waiting[lane.queue])
+            print(f'Worker {self.index}: {self.messages / elapsed:.1f} msg/s, waiting on its queues: '
+                  + ', '.join(f'{queue} {count}' for queue, count in waiting.items()))
+            self.messages, self._window_started = 0, time.monotonic()
+
+
+def consume_lanes(connection, lanes, read, flush, batch_size, batch_timeout, stopping=None, stats=None):
+    """
+    Fills a batch per lane and calls flush(channel, batch, queue, lag) on it
+    once it holds batch_size messages or its first one waited batch_timeout.
+    Every round flushes all ready lanes, higher priority first, so a backlog
+    on one queue holds the others up by at most one batch, and prefetch is
+    per lane, so it cannot take their share of unacked messages either.
+    read(properties, body) returns a message's (context, events, published_at)
+    and raises for one it cannot read, which is dead lettered.
+    """
+    def receiver(lane):
+        def on_message(channel, method, properties, body):
+            lane.messages[method.delivery_tag] = (method.routing_key, properties, body)
+            try:
+                context, events, published_at = read(properties, body)
+                lag = observe_delivery(lane.queue, published_at)
+            except Exception as e:
+                # retrying cannot make it readable
+                lane.reject(method.delivery_tag, e, retry=False)
+                return
+            lane.batch.append((method.delivery_tag, context, events))
+            lane.started = lane.started or time.monotonic()
+            lane.lag = max(lane.lag, lag)
+        return on_message
+
+    # exclusive, so a second consumer of a shard, e.g. from another container, is refused instead of
+    # reordering it. Run one consumer deployment per service and scale it with CONSUMER_WORKERS.
+    consumer_tags = {
+        lane.queue: lane.channel.basic_consume(queue=lane.queue, on_message_callback=receiver(lane), exclusive=True)
+        for lane in lanes
+    }
+    lanes = sorted(lanes, key=lambda lane: -lane.priority)
+
+    while True:
+        filling = [lane.started for lane in lanes if lane.batch]
+        wait = min(filling) + batch_timeout - time.monotonic() if filling else batch_timeout
+        connection.process_data_events(time_limit=max(wait, 0))
+
+        draining = stopping is not None and stopping.is_set()
+        flushed = 0
+        for lane in lanes:
+            if not lane.batch:
+                continue
+            if draining or len(lane.batch) >= batch_size or time.monotonic() - lane.started >= batch_timeout:
+                flushed += len(lane.batch)
+                flush_lane(lane, flush)
+                lane.started, lane.lag = None, 0
+        if stats is not None:
+            stats.record(flushed)
+
+        if draining:
+            # prefetched messages we have not started on go back to the broker when the connection closes
+            for lane in lanes:
+                lane.channel.basic_cancel(consumer_tags[lane.queue])
+            break
+
+
+def flush_lane(lane, flush):
+    """
+    Flushes the lane's batch. When that fails, every message is applied on
+    its own so that one bad message cannot hold up the rest, and the ones
+    that still fail are rejected before anything after them is acked.
+    """
+    entries = list(lane.batch)
+    try:
+        flush(lane.channel, lane.batch, lane.queue, lane.lag)
+    except Exception as e:
+        print(f'Batch of {len(entries)} failed, applying its messages one by one:', e)
+        batch_failures.labels(lane.queue).inc()
+        lane.batch.clear()
+        for entry in entries:
+            try:
+                flush(lane.channel, [entry], lane.queue, lane.lag)
+            except Exception as e:
+                lane.reject(entry[0], e)
+    for tag, _, _ in entries:
+        lane.messages.pop(tag, None)
+
+
+def describe_dead_letter(properties, body):
+    headers = properties.headers or {}
+    return {
+        'type': properties.type,
+        'content_type': properties.content_type,
+        'routing_key': headers.get(ROUTING_KEY),
+        'attempts': headers.get(ATTEMPTS, 0),
+        'error': headers.get(ERROR),
+        'failed_at': headers.get(FAILED_AT),
+        'bytes': len(body),
+    }
+
+
+def dead_letters(channel, queue, limit):
+    """
+    Up to limit messages from the front of a dead letter queue as (properties,
+    body) pairs. They are left unacked, so they go back in the same order
+    when the channel closes.
+    """
+    messages = []
+    while len(messages) < limit:
+        method, properties, body = channel.basic_get(queue=queue)
+        if method is None:
+            break
+        messages.append((properties, body))
+    return messages
+
+
+def replay_dead_letters(channel, queue, exchange, limit=None):
+    """
+    Publishes up to limit dead letters back to exchange with the routing key
+    they first arrived with and a fresh set of retries. Only the messages
+    queued when it starts are looked at, so ones that fail again while it
+    runs are not replayed twice. A message without its routing key goes to
+    the back of the queue. Returns how many were (replayed, skipped).
+    The channel should be in confirm mode, so each one is only acked here
+    once the broker has the copy.
+    """
+    waiting = channel.queue_declare(queue=queue, durable=True, passive=True).method.message_count
+    if limit is not None:
+        waiting = min(waiting, limit)
+
+    replayed = skipped = 0
+    for _ in range(waiting):
+        method, properties, body = channel.basic_get(queue=queue)
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        routing_key = headers.pop(ROUTING_KEY, None)
+        if routing_key is None:
+            print(f'Skipping a {properties.type} message without {ROUTING_KEY}')
+            channel.basic_publish(exchange='', routing_key=queue, body=body, properties=properties)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            skipped += 1
+            continue
+        for header in (ATTEMPTS, ERROR, FAILED_AT):
+            headers.pop(header, None)
+        properties.headers = headers
+        channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+    return replayed, skipped
+
+
+def _worker(target, index, stopping):
+    # the supervisor forwards SIGTERM; finish the current batch instead of dying mid-way
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        target(index, stopping)
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code != 403:
+            raise
+        # ACCESS_REFUSED: another consumer holds the shard, the supervisor retries with a growing delay
+        print(f'Worker {index} could not consume its shards exclusively, is another consumer running? {e.reply_text}')
+        raise SystemExit(1)
+
+
+def restart_delay(previous, ran_for):
+    """Seconds to wait before restarting a worker that died after ran_for seconds."""
+    if ran_for >= restart_max_delay:
+        return restart_min_delay
+    return min(max(previous * 2, restart_min_delay), restart_max_delay)
+
+
+def supervise(target, workers=consumer_workers):
+    """
+    Runs target(index, stopping) in workers forked processes and restarts any
+    that die, backing off while one keeps dying soon after it started. On SIGTERM or SIGINT every worker is asked to drain and stop,
+    and the ones still running after shutdown_timeout are killed.
+    """
+    if not consumer_shards:
+        raise SystemExit('Set CONSUMER_SHARDS to the number of queues each stream is split over')
+
+    context = multiprocessing.get_context('fork')
+    stopping = threading.Event()
+    processes = {}
+    started_at, delays, restart_at = {}, dict.fromkeys(range(workers), 0), {}
+
+    def start(index):
+        process = context.Process(target=_worker, args=(target, index, context.Event()), name=f'consumer-{index}')
+        process.start()
+        processes[index] = process
+        started_at[index] = time.monotonic()
+
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    for index in range(workers):
+        start(index)
+    print(f'Started {workers} consumer workers')
+
+    while not stopping.wait(1):
+        now = time.monotonic()
+        for index, process in list(processes.items()):
+            if index in restart_at:
+                if now >= restart_at[index]:
+                    del restart_at[index]
+                    start(index)
+            elif not process.is_alive():
+                delays[index] = restart_delay(delays[index], now - started_at[index])
+                print(f'Worker {index} exited with {process.exitcode}, restarting in {delays[index]:g}s')
+                restart_at[index] = now + delays[index]
+
+    print('Stopping consumer workers')
+    for process in processes.values():
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+
+    deadline = time.monotonic() + shutdown_timeout
+    for process in processes.values():
+        process.join(max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            print(f'{process.name} did not drain in time, killing it')
+            process.kill()
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# A JSON file to read instead of Secrets Manager, e.g. for local runs
+secrets_file = os.environ.get("SECRETS_FILE")
+# Fetched secrets are cached as 0600 files in a 0700 directory owned by this
+# user, <tmp>/secrets-<uid> unless set. Every worker and consumer in the
+# container shares it. A directory someone else owns, or others can read,
+# is not used and secrets are then fetched on every start.
+secrets_cache_dir = os.environ.get("SECRETS_CACHE_DIR", os.path.join(tempfile.gettempdir(), f'secrets-{os.getuid()}'))
+secrets_cache_ttl = float(os.environ.get("SECRETS_CACHE_TTL", "3600"))
+# a background refresh that has not finished after this long may be taken over
+secrets_refresh_timeout = float(os.environ.get("SECRETS_REFRESH_TIMEOUT", "60"))
+
+# seconds spent fetching secrets, for the startup report
+fetch_seconds = 0.0
+
+
+def _cache_dir():
+    """secrets_cache_dir, created if needed, or None when it is not private to us."""
+    try:
+        os.makedirs(secrets_cache_dir, mode=0o700, exist_ok=True)
+        stat = os.stat(secrets_cache_dir)
+    except OSError as e:
+        print(f"Secret cache unavailable: {e}")
+        return None
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        print(f"Secret cache unavailable: {secrets_cache_dir} must be a 0700 directory owned by this user")
+        return None
+    return secrets_cache_dir
+
+
+def _cache_path(secret_name):
+    digest = hashlib.sha256(secret_name.encode()).hexdigest()[:16]
+    return os.path.join(secrets_cache_dir, f'secret-{digest}.json')
+
+
+def _claim_refresh(path):
+    """
+    True for the one process that gets to refresh the cached secret. The
+    claim is a marker file next to it, so the cache keeps its age until a
+    refresh succeeds and a failed one is retried once the claim times out.
+    """
+    marker = path + '.refresh'
+    try:
+        if time.time() - os.path.getmtime(marker) < secrets_refresh_timeout:
+            return False
+        os.remove(marker)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+    except OSError:
+        return False
+    return True
+
+
+def _fetch(secret_name, region, cache=True):
+    global fetch_seconds
+    start = time.perf_counter()
+    # boto3 takes a noticeable part of startup, only import it when we really fetch
+    import boto3
+    from botocore.exceptions import ClientError
+
+    try:
+        print(f"Fetching secret: {secret_name}")
+        client = boto3.client("secretsmanager", region_name=region)
+        response = client.get_secret_value(SecretId=secret_name)
+    except ClientError as e:
+        print(f"Failed to fetch secret: {e}")
+        raise RuntimeError("Could not retrieve DB credentials")
+
+    if cache:
+        # mkstemp creates the file 0600
+        fd, tmp = tempfile.mkstemp(dir=secrets_cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(response["SecretString"])
+        os.replace(tmp, _cache_path(secret_name))
+
+    fetch_seconds += time.perf_counter() - start
+    return json.loads(response["SecretString"])
+
+
+def _refresh(secret_name, region):
+    try:
+        _fetch(secret_name, region)
+    except Exception as e:
+        print(f"Background secret refresh failed: {e}")
+        return
+    try:
+        os.remove(_cache_path(secret_name) + '.refresh')
+    except OSError:
+        pass
+
+
+def get_secret(secret_name, region):
+    """
+    Secret values as a dict. Served from SECRETS_FILE when set, otherwise from
+    an on-disk cache that is refreshed in the background once it is half way
+    to SECRETS_CACHE_TTL and fetched synchronously only when it has expired.
+    """
+    if secrets_file:
+        with open(secrets_file) as f:
+            return json.load(f)
+
+    if _cache_dir() is None:
+        return _fetch(secret_name, region, cache=False)
+
+    path = _cache_path(secret_name)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if age < secrets_cache_ttl:
+            with open(path) as f:
+                secrets = json.load(f)
+            if age >= secrets_cache_ttl / 2 and _claim_refresh(path):
+                threading.Thread(target=_refresh, args=(secret_name, region), daemon=True).start()
+            return secrets
+    except (OSError, ValueError):
+        pass
+
+    return _fetch(secret_name, region)
@@ -8,6 +8,9 @@ if [ ! -d "migrations/versions" ]; then
 fi
 flask db revision --rev-id=eef4f8759088
 
+# Duplicate likes would stop the user_product_unique index from being created
+flask dedupe-likes || echo "Like dedupe skipped"
+
 # Always try to make migrations (safe if no changes)
 echo "Running migrations..."
 flask db migrate -m "Auto migration" || echo "Migration skipped or already up to date"
@@ -15,7 +18,7 @@ flask db migrate -m "Auto migration" || echo "Migration skipped or already up to
 # Try upgrading, ignore if already at head
 flask db upgrade || echo "Upgrade failed. Possible mismatch in migration history."
 
-# Start the app
+# Start the app, gunicorn.conf.py starts every worker's like flush thread
 echo "Starting app..."
 exec gunicorn -b 0.0.0.0:5000 main:app
 
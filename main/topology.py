@@ -0,0 +1,95 @@
+import os
+
+# Each service has a topic exchange, <service>.events, that producers publish
+# to with <stream>.<partition> routing keys. Every stream gets its own
+# consistent-hash exchange, <service>.<stream>, bound to it, which spreads
+# the stream over CONSUMER_SHARDS queues, <service>.<stream>.<n>.
+# A partition always hashes to the same queue, so a product's events stay in
+# order. Needs the rabbitmq_consistent_hash_exchange plugin on the broker.
+EVENTS_EXCHANGE_TYPE = 'topic'
+SHARD_EXCHANGE_TYPE = 'x-consistent-hash'
+
+# A product's created, updated and deleted events must be applied in order,
+# so they share the products stream. Every other event type is a stream of its own.
+EVENT_STREAMS = {
+    'product_created': 'products',
+    'product_updated': 'products',
+    'product_deleted': 'products',
+}
+
+# A worker flushes its ready streams highest first, 1 when not listed
+STREAM_PRIORITIES = {
+    'products': 2,
+}
+
+# must match between all producers of product events
+event_partitions = int(os.environ.get("EVENT_PARTITIONS", "64"))
+
+# Seconds a message that failed on its own waits before each retry. Each
+# delay is a queue per shard queue whose messages expire back into it, after
+# the last one the message goes to the stream's dead letter queue.
+retry_delays = [float(delay) for delay in os.environ.get("CONSUMER_RETRY_DELAYS", "1,10,60,300,900").split(',') if delay]
+
+
+def product_key(body):
+    """Partition for an event body: a product dict or a bare product id."""
+    return str(int(body['id'] if isinstance(body, dict) else body) % event_partitions)
+
+
+def event_stream(event_type):
+    return EVENT_STREAMS.get(event_type, event_type)
+
+
+def stream_priority(stream):
+    return STREAM_PRIORITIES.get(stream, 1)
+
+
+def routing_key(event_type, partition):
+    return f'{event_stream(event_type)}.{partition}'
+
+
+def events_exchange(service):
+    return f'{service}.events'
+
+
+def shard_queue(service, stream, index):
+    return f'{service}.{stream}.{index}'
+
+
+def retry_queue(queue, delay):
+    # named after the delay, as a queue's TTL cannot change once declared
+    return f'{queue}.retry.{delay:g}s'
+
+
+def dead_letter_queue(service, stream):
+    return f'{service}.{stream}.dead'
+
+
+def declare_exchange(channel, exchange):
+    channel.exchange_declare(exchange=exchange, exchange_type=EVENTS_EXCHANGE_TYPE, durable=True)
+
+
+def declare_topology(channel, service, streams, shards):
+    """
+    Declares the service's events exchange and, for every stream, its shard
+    exchange, shards equally weighted queues with their retry queues, and
+    its dead letter queue. Everything is idempotent, so each consumer worker
+    runs it on start.
+    """
+    declare_exchange(channel, events_exchange(service))
+    for stream in streams:
+        exchange = f'{service}.{stream}'
+        channel.exchange_declare(exchange=exchange, exchange_type=SHARD_EXCHANGE_TYPE, durable=True)
+        channel.exchange_bind(destination=exchange, source=events_exchange(service), routing_key=f'{stream}.*')
+        for index in range(shards):
+            queue = shard_queue(service, stream, index)
+            channel.queue_declare(queue=queue, durable=True)
+            # for consistent-hash exchanges the binding key is the queue's weight
+            channel.queue_bind(queue=queue, exchange=exchange, routing_key='1')
+            for delay in retry_delays:
+                channel.queue_declare(queue=retry_queue(queue, delay), durable=True, arguments={
+                    'x-message-ttl': int(delay * 1000),
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': queue,
+                })
+        channel.queue_declare(queue=dead_letter_queue(service, stream), durable=True)
@@ -0,0 +1,151 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from opentelemetry import trace
+
+tracer = trace.get_tracer(__name__)
+
+user_api_url = os.environ.get("USER_API_URL", "https://django.seyram.site/api/user")
+user_ids_api_url = os.environ.get("USER_IDS_API_URL", "https://django.seyram.site/api/users/ids")
+user_api_timeout = (
+    float(os.environ.get("USER_API_CONNECT_TIMEOUT", "0.5")),
+    float(os.environ.get("USER_API_READ_TIMEOUT", "1")),
+)
+user_api_pool_size = int(os.environ.get("USER_API_POOL_SIZE", "10"))
+breaker_failures = int(os.environ.get("USER_API_BREAKER_FAILURES", "5"))
+breaker_reset = float(os.environ.get("USER_API_BREAKER_RESET", "30"))
+# 0 disables the local pool and every like asks the admin service for a user
+user_pool_refresh = float(os.environ.get("USER_POOL_REFRESH", "0"))
+user_pool_size = int(os.environ.get("USER_POOL_SIZE", "10000"))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class UserServiceError(requests.RequestException):
+    """The admin service answered, but not with the JSON we asked for."""
+
+
+class CircuitBreaker:
+    """
+    Fails fast for reset_timeout seconds after max_failures consecutive
+    errors, then lets a single trial call through to probe the service.
+    """
+
+    def __init__(self, max_failures, reset_timeout):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is not None:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError('User service circuit is open')
+                # half-open: let this call through, keep others failing fast
+                self._opened_at = time.monotonic()
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+def _session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=user_api_pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+session = _session()
+breaker = CircuitBreaker(breaker_failures, breaker_reset)
+
+
+def response_field(response, key):
+    """response.json()[key], or UserServiceError when the body does not have it."""
+    try:
+        return response.json()[key]
+    except (ValueError, KeyError, TypeError) as e:
+        raise UserServiceError(f'Unexpected response from {response.url}: {e!r}') from e
+
+
+def _get(url, key, **params):
+    response = session.get(url, params=params, timeout=user_api_timeout)
+    response.raise_for_status()
+    return response_field(response, key)
+
+
+class UserPool:
+    """
+    Local copy of user ids from the admin service, refreshed by a daemon
+    thread so likes can pick a user without a synchronous hop.
+    """
+
+    def __init__(self, refresh_interval, size):
+        self.refresh_interval = refresh_interval
+        self.size = size
+        self.ids = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with tracer.start_as_current_span("refresh_user_pool") as span:
+            self.ids = breaker.call(_get, user_ids_api_url, 'ids', limit=self.size)
+            span.set_attribute("user_pool.size", len(self.ids))
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print('User pool refresh failed:', e)
+            time.sleep(self.refresh_interval)
+
+    def start(self):
+        # threads do not survive a gunicorn fork, so start lazily in each worker
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='user-pool', daemon=True).start()
+
+    def choice(self):
+        self.start()
+        ids = self.ids
+        return random.choice(ids) if ids else None
+
+
+user_pool = UserPool(user_pool_refresh, user_pool_size) if user_pool_refresh > 0 else None
+
+
+def random_user_id():
+    if user_pool is not None:
+        user_id = user_pool.choice()
+        if user_id is not None:
+            return user_id
+
+    return breaker.call(_get, user_api_url, 'id')